@@ -0,0 +1,99 @@
+"""
+-----------------------------------------------------------------------------------------
+import_time.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Guard the start-up time of the analysis entry points: the import statements of
+each script or helper module are run in a fresh interpreter, timed against a
+budget and checked for heavy modules they should not load
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: number of repetitions per entry point (optional, default 3)
+sys.argv[2]: budget scaling factor for slow machines (optional, default 1)
+-----------------------------------------------------------------------------------------
+Output(s):
+table of import times, exit status 1 if a budget is exceeded or a forbidden module loaded
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python benchmarks/import_time.py 5
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import ast
+import os
+import sys
+import json
+import subprocess
+opj = os.path.join
+
+# Get inputs
+if len(sys.argv) > 1: num_rep = int(sys.argv[1])
+else: num_rep = 3
+if len(sys.argv) > 2: budget_scale = float(sys.argv[2])
+else: budget_scale = 1.0
+
+# Entry points: budget in seconds and modules that must not be loaded
+no_debug = ['ipdb','matplotlib.pyplot']
+no_draw = ['ipdb','matplotlib','cortex','skimage']
+entry_points = {'fit/fit_utils.py':             (0.5, no_draw + ['popeye','nibabel']),
+                'fit/prf_fit.py':               (0.5, no_draw + ['popeye']),
+                'fit/submit_fit_jobs.py':       (0.5, no_draw + ['popeye']),
+                'fit/launch_submit_fit_jobs.py':(0.5, no_draw + ['popeye']),
+                'fit/lease_fit_jobs.py':        (0.5, no_draw + ['popeye']),
+                'fit/batch_fit.py':             (0.5, no_draw + ['popeye']),
+                'fit/manifest.py':              (0.5, no_draw + ['popeye']),
+                'fit/stage_report.py':          (0.5, no_draw + ['popeye']),
+                'fit/convert_ts_store.py':      (0.5, no_draw + ['popeye']),
+                'post_fit/utils.py':            (1.0, no_draw),
+                'post_fit/group_stats.py':      (0.5, no_draw + ['nibabel']),
+                'post_fit/pp_roi.py':           (1.0, no_draw),
+                'post_fit/post_pp_roi.py':      (1.0, no_debug + ['cortex']),
+                'post_fit/add_dmn_roi.py':      (3.0, no_debug)}
+
+timing_code = """
+import sys, time, json
+sys.path[:0] = {paths}
+start = time.perf_counter()
+{imports}
+dur = time.perf_counter() - start
+print(json.dumps([dur, sorted(sys.modules.keys())]))
+"""
+
+def entry_imports(file_name):
+    """import statements of the module level of a file"""
+    with open(file_name) as f:
+        source = f.read()
+    return '\n'.join([ast.get_source_segment(source, node) for node in ast.parse(source).body
+                        if isinstance(node, ast.Import) or (isinstance(node, ast.ImportFrom) and node.module != '__future__')])
+
+# Time entry points
+num_fail = 0
+print('%-32s %10s %10s  %s'%('entry point','time (s)','budget (s)','status'))
+for entry_point, (budget, forbidden) in entry_points.items():
+    code = timing_code.format(  paths = json.dumps([opj(os.getcwd(), os.path.split(entry_point)[0]), opj(os.getcwd(),'fit')]),
+                                imports = entry_imports(entry_point))
+
+    durs, status = [], 'ok'
+    for rep in range(num_rep):
+        run = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True)
+        if run.returncode != 0:
+            status = 'skipped (%s)'%run.stderr.strip().split('\n')[-1]
+            break
+        dur, modules = json.loads(run.stdout.strip().split('\n')[-1])
+        durs.append(dur)
+
+    if len(durs) == num_rep:
+        loaded = [module for module in forbidden if module in modules]
+        if len(loaded) > 0:
+            status = 'FAIL: loads %s'%', '.join(loaded)
+            num_fail += 1
+        elif min(durs) > budget * budget_scale:
+            status = 'FAIL: over budget'
+            num_fail += 1
+        print('%-32s %10.3f %10.3f  %s'%(entry_point, min(durs), budget * budget_scale, status))
+    else:
+        print('%-32s %10s %10.3f  %s'%(entry_point, '-', budget * budget_scale, status))
+
+sys.exit(1 if num_fail > 0 else 0)
@@ -0,0 +1,317 @@
+"""
+-----------------------------------------------------------------------------------------
+synthetic_fit.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Benchmark fitting and post-processing without the HCP data: time series of known
+gaussian/css pRFs on a bar stimulus are fitted by slices (fit_slice of fit/fit_utils.py,
+as called by prf_fit.py jobs), merged, converted to pRF derivatives and extracted to
+roi h5 files. Throughput, peak memory and parameter recovery are stored per git commit
+for comparison.
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: action ('run','report')
+run:
+sys.argv[2]: fit model ('gauss','css')
+sys.argv[3]: vertices per hemisphere (optional, default 2000)
+sys.argv[4]: noise level, noise sd / signal sd (optional, default 0.5)
+sys.argv[5]: vertices per slice (optional, default 500)
+sys.argv[6]: number of processes (optional, default number of cpu)
+report:
+sys.argv[2]: fit model (optional, default all)
+-----------------------------------------------------------------------------------------
+Output(s):
+benchmarks/results/synthetic_fit.jsonl (one line per run, with git commit)
+benchmarks/results/work/ (synthetic data, fit and prediction bank, kept between runs)
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python benchmarks/synthetic_fit.py run gauss 2000 0.5 500 8
+python benchmarks/synthetic_fit.py report gauss
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import numpy as np
+opj = os.path.join
+import warnings
+warnings.filterwarnings('ignore')
+
+# Functions import
+sys.path.append(opj(os.getcwd(),'fit'))
+sys.path.append(opj(os.getcwd(),'post_fit'))
+from fit_utils import setup_fit, init_fit_worker, fit_slice, stage_log_file, log_stage, read_stage_logs
+from fit_utils import rss_lifetime_peak_mb
+
+# Get inputs
+action = sys.argv[1]
+results_dir = opj(os.getcwd(),'benchmarks','results')
+results_file = opj(results_dir,'synthetic_fit.jsonl')
+subject = 'synthetic'
+base_file_name = 'tfMRI_RETBAR1_7T_AP_Atlas_MSMAll_hp2000_clean.dtseries'
+
+def make_bar_stimulus(num_tr, num_pix = 200, bar_width = 0.25):
+    """
+    Bar stimulus in a circular aperture: 8 sweeps (4 orientations x 2 directions)
+    with blank periods after the 4th and 8th sweeps
+
+    Parameters
+    ----------
+    num_tr: number of time points
+    num_pix: number of pixels of the square stimulus
+    bar_width: bar width in aperture radius
+
+    Returns
+    -------
+    stim: array (pixels x pixels x time points) of 0/1
+    """
+
+    xx, yy = np.meshgrid(np.linspace(-1, 1, num_pix), np.linspace(-1, 1, num_pix))
+    aperture = xx**2 + yy**2 <= 1
+    blank_num = num_tr//12
+    sweep_num = (num_tr - 2*blank_num)//8
+
+    stim = np.zeros((num_pix, num_pix, num_tr), dtype = np.uint8)
+    tr = 0
+    for sweep, angle in enumerate(np.arange(0, 360, 45)):
+        proj = xx*np.cos(np.deg2rad(angle)) + yy*np.sin(np.deg2rad(angle))
+        for bar_pos in np.linspace(-1 - bar_width/2, 1 + bar_width/2, sweep_num):
+            stim[:,:,tr] = (np.abs(proj - bar_pos) <= bar_width/2) & aperture
+            tr += 1
+        if sweep in [3, 7]: tr += blank_num
+
+    return stim
+
+def make_synthetic_prfs(model_func, fit_model, vox_num, noise, stim_radius, seed):
+    """
+    Draw pRF parameters and their noisy time series
+
+    Parameters
+    ----------
+    model_func: popeye model
+    fit_model: fit model ('gauss','css')
+    vox_num: number of vertices
+    noise: noise sd / signal sd
+    stim_radius: stimulus radius in deg
+    seed: random seed
+
+    Returns
+    -------
+    params: array (fit parameters x vertices) of true x, y, sigma, (n), beta, baseline
+    data: array (time points x vertices) of time series
+    """
+
+    rng = np.random.RandomState(seed)
+    ecc = stim_radius * 0.9 * np.sqrt(rng.uniform(0, 1, vox_num))
+    polar = rng.uniform(-np.pi, np.pi, vox_num)
+    sigma = rng.uniform(0.5, 1.5, vox_num) * (0.5 + 0.3 * ecc)
+    beta = rng.uniform(1, 5, vox_num) * np.where(rng.uniform(0, 1, vox_num) < 0.2, -1, 1)
+    baseline = rng.normal(0, 0.5, vox_num)
+    if fit_model == 'gauss':
+        params = np.vstack((ecc*np.cos(polar), ecc*np.sin(polar), sigma, beta, baseline))
+    elif fit_model == 'css':
+        params = np.vstack((ecc*np.cos(polar), ecc*np.sin(polar), sigma, rng.uniform(0.2, 1, vox_num), beta, baseline))
+
+    data = np.zeros((model_func.stimulus.stim_arr.shape[-1], vox_num))
+    for num_vox in range(vox_num):
+        signal = np.nan_to_num(model_func.generate_prediction(*params[:,num_vox]))
+        data[:,num_vox] = signal + rng.normal(0, noise * np.std(signal) + 1e-6, signal.shape[0])
+
+    return params, data
+
+def git_commit():
+    """commit of the benchmarked tree, with a flag for uncommitted changes"""
+    try:
+        commit = subprocess.run(['git','rev-parse','HEAD'], capture_output = True, text = True).stdout.strip()
+        dirty = len(subprocess.run(['git','status','--porcelain','--untracked-files=no'], capture_output = True, text = True).stdout.strip()) > 0
+    except OSError:
+        commit, dirty = '', False
+
+    return commit, dirty
+
+if action == 'run':
+
+    # Imports
+    import multiprocessing
+    import scipy.io
+    import nibabel as nb
+    from utils import merge_fit_chunks, convert_fit_results, roi_derivs_2_hdf5
+
+    # Get inputs
+    fit_model = sys.argv[2]
+    vox_num = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    noise = float(sys.argv[4]) if len(sys.argv) > 4 else 0.5
+    job_vox = int(sys.argv[5]) if len(sys.argv) > 5 else 500
+    n_procs = int(sys.argv[6]) if len(sys.argv) > 6 else multiprocessing.cpu_count()
+    if fit_model == 'gauss': fit_val = 6
+    elif fit_model == 'css': fit_val = 7
+
+    # Define analysis parameters: benchmark with settings.json except data specific ones
+    with open('settings.json') as f:
+        json_s = f.read()
+        analysis_info = json.loads(json_s)
+    analysis_info['triage_mask'] = ''
+    if analysis_info['fit_grid_search'] == 'warm': analysis_info['fit_grid_search'] = 'batch'
+
+    # Work directory: prediction bank kept between runs, subject outputs cleaned
+    base_dir = opj(results_dir,'work')
+    shutil.rmtree(opj(base_dir,'pp_data',subject), ignore_errors = True)
+    shutil.rmtree(opj(base_dir,'raw_data',subject), ignore_errors = True)
+    if os.path.isfile(opj(base_dir,'pp_data','manifest.sqlite')): os.remove(opj(base_dir,'pp_data','manifest.sqlite'))
+    os.makedirs(opj(base_dir,'raw_data',subject))
+    log_file = stage_log_file(base_dir, subject, fit_model)
+    log_info = {'subject': subject, 'fit_model': fit_model}
+
+    # Create synthetic stimulus, model and data
+    print('creating synthetic data: %i vertices per hemisphere, noise %.2f'%(vox_num, noise))
+    scipy.io.savemat(opj(base_dir,'raw_data','retinotopysmall5.mat'), {'stim': make_bar_stimulus(analysis_info['n_timepoints_per_run'])})
+    with log_stage(log_file, 'setup', **log_info):
+        fit_setup = setup_fit(fit_model, base_dir, analysis_info)
+
+    true_params, data_files = {}, {}
+    for hemi_num, hemi in enumerate(['L','R']):
+        true_params[hemi], data = make_synthetic_prfs(  model_func = fit_setup['model_func'],
+                                                        fit_model = fit_model,
+                                                        vox_num = vox_num,
+                                                        noise = noise,
+                                                        stim_radius = analysis_info['stim_radius'],
+                                                        seed = hemi_num)
+        data_files[hemi] = opj(base_dir,'raw_data',subject,'{bfn}_{hemi}.func_bla_psc_av.gii'.format(bfn = base_file_name, hemi = hemi))
+        darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in data.astype(np.float32)]
+        nb.save(nb.gifti.gifti.GiftiImage(darrays = darrays), data_files[hemi])
+
+    # Fit by slices as prf_fit.py jobs
+    with log_stage(log_file, 'pool_start', **log_info):
+        pool = multiprocessing.Pool(processes = n_procs,
+                                    initializer = init_fit_worker,
+                                    initargs = (fit_setup['model_func'],))
+    fit_start = time.perf_counter()
+    fit_files = {}
+    for hemi in ['L','R']:
+        fit_files[hemi] = []
+        for start_idx in np.arange(0, vox_num, job_vox):
+            fit_files[hemi].append(fit_slice(   pool = pool,
+                                                fit_setup = fit_setup,
+                                                subject = subject,
+                                                data_file = data_files[hemi],
+                                                start_idx = start_idx,
+                                                end_idx = np.min((start_idx + job_vox, vox_num)),
+                                                base_dir = base_dir,
+                                                analysis_info = analysis_info))
+    fit_wall = time.perf_counter() - fit_start
+    pool.close()
+    pool.join()
+
+    # Merge slices, compute derivatives and extract rois as pp_roi.py and post_pp_roi.py
+    deriv_dir = opj(base_dir,'pp_data',subject,fit_model,'deriv')
+    fit_est, deriv_data = {}, {}
+    for hemi in ['L','R']:
+        est_file = opj(base_dir,'pp_data',subject,fit_model,'fit','{bfn}_{hemi}.func_bla_psc_est.gii'.format(bfn = base_file_name, hemi = hemi))
+        with log_stage(log_file, 'merge', hemi = hemi, **log_info) as stage:
+            fit_est[hemi] = merge_fit_chunks(   chunk_files = fit_files[hemi],
+                                                output_file = est_file,
+                                                vox_num = vox_num,
+                                                fit_val = fit_val)[0]
+            stage['vertices'] = vox_num
+        with log_stage(log_file, 'derivatives', hemi = hemi, **log_info) as stage:
+            prf_deriv = convert_fit_results(prf_filename = [est_file],
+                                            output_dir = deriv_dir,
+                                            stim_radius = analysis_info['stim_radius'],
+                                            hemi = hemi,
+                                            fit_model = fit_model,
+                                            memory_budget = analysis_info['cov_memory_budget'],
+                                            cov_method = analysis_info['cov_method'])
+            stage['vertices'] = vox_num
+        for mask_dir in ['all','pos','neg']:
+            deriv_data[(hemi, mask_dir)] = prf_deriv[mask_dir]
+
+    # synthetic rois: contiguous vertex ranges
+    roi_idx = {hemi: {roi: roi_vox.astype(np.int32) for roi, roi_vox in zip(analysis_info['rois'], np.array_split(np.arange(vox_num), len(analysis_info['rois'])))}
+                for hemi in ['L','R']}
+    with log_stage(log_file, 'roi_hdf5', **log_info) as stage:
+        roi_derivs_2_hdf5(  deriv_data = deriv_data,
+                            roi_idx = roi_idx,
+                            h5_dir = opj(base_dir,'pp_data',subject,fit_model,'h5'))
+        stage['vertices'] = 2 * vox_num
+
+    # Parameter recovery
+    est = np.hstack([fit_est[hemi] for hemi in ['L','R']])
+    true = np.hstack([true_params[hemi] for hemi in ['L','R']])
+    pos_err = np.sqrt((est[0,:] - true[0,:])**2 + (est[1,:] - true[1,:])**2)
+    recovery = {'pos_err_median_deg': float(np.nanmedian(pos_err)),
+                'pos_err_below_1deg': float(np.nanmean(pos_err < 1)),
+                'size_rel_err_median': float(np.nanmedian(np.abs(est[2,:] - true[2,:])/true[2,:])),
+                'beta_sign_match': float(np.nanmean(np.sign(est[fit_val-3,:]) == np.sign(true[fit_val-3,:]))),
+                'rsq_median': float(np.nanmedian(est[fit_val-1,:]))}
+    if fit_model == 'css':
+        recovery['n_err_median'] = float(np.nanmedian(np.abs(est[3,:] - true[3,:])))
+
+    # Stage throughput and memory from stage timing log
+    stages = {}
+    for record in read_stage_logs([log_file]):
+        stage = stages.setdefault(record['stage'], {'runs': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'vertices': 0, 'rss_peak_growth_mb': 0.0})
+        stage['runs'] += 1
+        stage['wall_s'] += record['wall_s']
+        stage['cpu_s'] += record['cpu_s'] + record.get('vertex_time_sum_s', 0.0)
+        stage['vertices'] += record['vertices'] or 0
+        stage['rss_peak_growth_mb'] = max(stage['rss_peak_growth_mb'], record['rss_peak_growth_mb'])
+    for stage in stages.values():
+        stage['vertices_per_s'] = stage['vertices']/stage['wall_s'] if stage['vertices'] > 0 and stage['wall_s'] > 0 else None
+
+    # Store results by commit
+    commit, dirty = git_commit()
+    result = {  'commit': commit,
+                'dirty': dirty,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': platform.uname()[1],
+                'cpu_num': multiprocessing.cpu_count(),
+                'numpy': np.__version__,
+                'config': {'fit_model': fit_model, 'vox_num': vox_num, 'noise': noise, 'job_vox': job_vox,
+                           'n_procs': n_procs, 'fit_grid_search': analysis_info['fit_grid_search'], 'fit_step': analysis_info['fit_step']},
+                'fit_wall_s': fit_wall,
+                'fit_vertices_per_s': 2 * vox_num / fit_wall,
+                'rss_lifetime_peak_mb': rss_lifetime_peak_mb(),
+                'rss_children_lifetime_peak_mb': rss_lifetime_peak_mb(children = True),
+                'stages': stages,
+                'recovery': recovery}
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    print('%-16s %10s %10s %12s %10s'%('stage','wall (s)','cpu (s)','vertex/s','+rss (MB)'))
+    for stage_name, stage in stages.items():
+        print('%-16s %10.2f %10.2f %12s %10.0f'%(stage_name, stage['wall_s'], stage['cpu_s'],
+            '%.1f'%stage['vertices_per_s'] if stage['vertices_per_s'] else '-', stage['rss_peak_growth_mb']))
+    print('fit: %.1f vertices/s, peak memory %.0f MB (workers %.0f MB)'%(result['fit_vertices_per_s'], result['rss_lifetime_peak_mb'], result['rss_children_lifetime_peak_mb']))
+    print('recovery: ' + ', '.join(['%s %.3f'%(key, val) for key, val in recovery.items()]))
+
+elif action == 'report':
+
+    # Compare runs of same configuration between commits
+    if not os.path.isfile(results_file):
+        sys.exit('no benchmark results in %s'%results_file)
+    with open(results_file) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    if len(sys.argv) > 2: results = [result for result in results if result['config']['fit_model'] == sys.argv[2]]
+
+    configs = {}
+    for result in results:
+        configs.setdefault((result['host'], json.dumps(result['config'], sort_keys = True)), []).append(result)
+
+    for (host, config), config_results in configs.items():
+        print('\n%s %s'%(host, config))
+        print('%-10s %-19s %12s %12s %12s %10s %10s %8s'%('commit','time','fit vert/s','merge vert/s','deriv vert/s','peak (MB)','pos err','rsq'))
+        ref_rate = None
+        for result in config_results:
+            rate = [result['fit_vertices_per_s']] + [(result['stages'].get(stage) or {}).get('vertices_per_s') or np.nan for stage in ['merge','derivatives']]
+            change = '' if ref_rate is None else ' (%+.0f%%)'%(100*(rate[0]/ref_rate - 1))
+            print('%-10s %-19s %12.1f %12.1f %12.1f %10.0f %10.3f %8.3f%s'%(result['commit'][:8] + ('+' if result['dirty'] else ''), result['time'],
+                rate[0], rate[1], rate[2], max(result['rss_lifetime_peak_mb'], result['rss_children_lifetime_peak_mb']),
+                result['recovery']['pos_err_median_deg'], result['recovery']['rsq_median'], change))
+            ref_rate = rate[0]
@@ -0,0 +1,118 @@
+"""
+-----------------------------------------------------------------------------------------
+batch_fit.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Fit many subjects in one process: stimulus, model and process pool are built once
+and (subject, hemisphere, vertex slice) work items are streamed through them
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: fit model ('gauss','css')
+sys.argv[2]: fittable voxel per slice (e.g. 400)
+sys.argv[3:]: subject names (optional, default all subjects of settings.json)
+-----------------------------------------------------------------------------------------
+Output(s):
+Gifti image files with fitting parameters per slice (same names as prf_fit.py)
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python fit/batch_fit.py gauss 400 192641 105923
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import sys
+import multiprocessing
+import numpy as np
+import platform
+import os
+import glob
+import json
+opj = os.path.join
+import warnings
+warnings.filterwarnings('ignore')
+
+# Functions import
+from fit_utils import setup_fit, init_fit_worker, fit_slice
+from fit_utils import open_manifest, manifest_data_shape, manifest_register_chunks, manifest_chunks
+from fit_utils import manifest_refresh_chunks, manifest_update_chunk
+from fit_utils import load_ts_columns, triage_vertices, load_triage_mask, balance_chunks
+
+# Get inputs
+fit_model = sys.argv[1]
+job_vox = float(sys.argv[2])
+
+# Define analysis parameters
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+if len(sys.argv) > 3: subjects = sys.argv[3:]
+else: subjects = analysis_info['subject_list']
+
+# Define cluster/server specific parameters
+if 'lisa' in platform.uname()[1]:
+    N_PROCS = 16
+    base_dir = analysis_info['lisa_cluster_base_folder']
+elif 'aeneas' in platform.uname()[1]:
+    N_PROCS = 31
+    base_dir = analysis_info['aeneas_base_folder']
+elif 'local' in platform.uname()[1]:
+    N_PROCS = 8
+    base_dir = analysis_info['local_base_folder']
+
+# Create stimulus design, model and pool once
+fit_setup = setup_fit(fit_model, base_dir, analysis_info)
+pool = multiprocessing.Pool(processes = N_PROCS,
+                            initializer = init_fit_worker,
+                            initargs = (fit_setup['model_func'],))
+manifest = open_manifest(opj(base_dir,'pp_data','manifest.sqlite'))
+
+# Stream work items
+failed_chunks = []
+for subject in subjects:
+    for hemi in ['L','R']:
+        data_file = sorted(glob.glob(opj(base_dir,'raw_data',subject,'*RETBAR1_7T*%s.func_bla_psc_av.gii'% hemi)))
+        manifest_data_shape(manifest, subject, hemi, data_file[0])
+
+        chunks = manifest_refresh_chunks(manifest, subject, fit_model, hemi)
+        if len(chunks) == 0:
+            # slices with similar number of fittable vertices
+            if analysis_info['triage_mask']: triage_mask_file = opj(base_dir,'raw_data',analysis_info['triage_mask'].format(hemi = hemi))
+            else: triage_mask_file = None
+            fittable = triage_vertices( data = load_ts_columns(data_file[0])[0],
+                                        mask = load_triage_mask(triage_mask_file))
+            start_idx, end_idx = balance_chunks(fittable, job_vox)
+            base_file_name = os.path.split(data_file[0])[-1][:-7]
+            manifest_register_chunks(manifest, subject, hemi, fit_model,
+                [(start_idx[iter_job], end_idx[iter_job], opj(base_dir,'pp_data',subject,fit_model,'fit',
+                    base_file_name + '_est_%i_to_%i.gii' %(start_idx[iter_job],end_idx[iter_job])))
+                    for iter_job in np.arange(0,start_idx.shape[0],1)])
+            chunks = manifest_chunks(manifest, subject, fit_model, hemi)
+
+        for chunk in chunks:
+            if chunk['done']: continue
+            print('fitting %s %s vox num: %i to %i'%(subject,hemi,chunk['start_idx'],chunk['end_idx']))
+            try:
+                fit_slice(  pool = pool,
+                            fit_setup = fit_setup,
+                            subject = subject,
+                            data_file = data_file[0],
+                            start_idx = chunk['start_idx'],
+                            end_idx = chunk['end_idx'],
+                            base_dir = base_dir,
+                            analysis_info = analysis_info)
+                manifest_update_chunk(manifest, chunk['output_file'])
+            except Exception as error:
+                # keep streaming other slices, slice stays not done in manifest
+                print('fit of %s %s vox num: %i to %i failed: %s'%(subject,hemi,chunk['start_idx'],chunk['end_idx'],error))
+                manifest_update_chunk(manifest, chunk['output_file'])
+                failed_chunks.append(chunk['output_file'])
+
+# Free up memory
+pool.close()
+pool.join()
+manifest.close()
+
+if len(failed_chunks) > 0:
+    sys.exit('%i slice fits failed:\n%s'%(len(failed_chunks), '\n'.join(failed_chunks)))
@@ -0,0 +1,56 @@
+"""
+-----------------------------------------------------------------------------------------
+convert_ts_store.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Convert once the time-series gifti files into vertex-major binary stores
+read by submit_fit_jobs.py, prf_fit.py, pp_roi.py and post_pp_roi.py
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1:]: subject names (optional, default all subjects of settings.json)
+-----------------------------------------------------------------------------------------
+Output(s):
+<data file>_store folder per subject and hemisphere
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python fit/convert_ts_store.py 999999 192641
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import os
+import glob
+import json
+import sys
+import platform
+opj = os.path.join
+
+# Functions import
+from fit_utils import convert_gii_to_store, ts_store_info
+
+# Load the analysis parameters from json file
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+# Define server or cluster settings
+if 'lisa' in platform.uname()[1]:
+    base_dir = analysis_info['lisa_cluster_base_folder']
+elif 'aeneas' in platform.uname()[1]:
+    base_dir = analysis_info['aeneas_base_folder']
+elif 'local' in platform.uname()[1]:
+    base_dir = analysis_info['local_base_folder']
+
+# Get subjects
+if len(sys.argv) > 1: subjects = sys.argv[1:]
+else: subjects = analysis_info['subject_list']
+
+# Convert time series
+for subject in subjects:
+    for data_file in sorted(glob.glob(opj(base_dir,'raw_data',subject,'*RETBAR1_7T*.func_bla_psc_av.gii'))):
+        if ts_store_info(data_file) is not None:
+            print('%s store is up to date'%data_file)
+            continue
+        print('converting %s'%data_file)
+        convert_gii_to_store(data_file)
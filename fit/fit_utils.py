@@ -0,0 +1,1368 @@
+import os
+import json
+import time
+import platform
+import contextlib
+import numpy as np
+
+# popeye model of pool workers (see init_fit_worker)
+worker_model_func = None
+
+# log10 bin edges (s) of per-vertex fit time histograms (see log_stage)
+vertex_time_bins = np.arange(-3, 3.25, 0.25)
+
+def make_grid_points(fit_model_grids, Ns):
+    """
+    Define the brute-force search grid used by popeye
+
+    Parameters
+    ----------
+    fit_model_grids: tuple of (min, max) search range per grid parameter
+    Ns: number of samples per grid parameter (as in scipy.optimize.brute)
+
+    Returns
+    -------
+    grid_points: array (grid points x grid parameters)
+    """
+
+    grid_axes = [np.linspace(grid[0], grid[1], Ns) for grid in fit_model_grids]
+    grid_mesh = np.meshgrid(*grid_axes, indexing = 'ij')
+    grid_points = np.vstack([mesh.ravel() for mesh in grid_mesh]).T
+
+    return grid_points
+
+def make_grid_predictions(model_func, grid_points):
+    """
+    Generate unscaled model time course for every grid point
+
+    Parameters
+    ----------
+    model_func: popeye model (og.GaussianModel or css.CompressiveSpatialSummationModel)
+    grid_points: array (grid points x grid parameters)
+
+    Returns
+    -------
+    predictions: array (grid points x time points) of predictions with beta = 1 and baseline = 0
+    """
+
+    predictions = []
+    for grid_point in grid_points:
+        predictions.append(model_func.generate_prediction(*grid_point, 1.0, 0.0))
+    predictions = np.nan_to_num(np.array(predictions))
+
+    return predictions
+
+def grid_search_batch(predictions, grid_points, data, block_size = 5000):
+    """
+    Find best grid point of many vertices at once,
+    scoring all grid predictions with a normalized matrix product
+
+    Parameters
+    ----------
+    predictions: array (grid points x time points) of unscaled predictions
+    grid_points: array (grid points x grid parameters)
+    data: array (time points x vertices)
+    block_size: number of vertices scored per matrix product
+
+    Returns
+    -------
+    ballpark: array (vertices x (grid parameters + beta + baseline)) of starting points
+    rsq: array (vertices) of r-square of the best grid point
+    """
+
+    # normalize predictions
+    pred_mean = predictions.mean(axis = 1)
+    pred_dm = predictions - pred_mean[:,np.newaxis]
+    pred_norm = np.linalg.norm(pred_dm, axis = 1)
+    pred_valid = pred_norm > 0
+    pred_z = np.zeros(pred_dm.shape)
+    pred_z[pred_valid,:] = pred_dm[pred_valid,:]/pred_norm[pred_valid,np.newaxis]
+
+    ballpark = np.zeros((data.shape[1], grid_points.shape[1] + 2))
+    rsq = np.zeros(data.shape[1])
+    for block_start in np.arange(0, data.shape[1], block_size):
+        block_end = np.min((block_start + block_size, data.shape[1]))
+
+        # normalize data
+        data_block = np.nan_to_num(data[:,block_start:block_end].astype(np.float64))
+        data_mean = data_block.mean(axis = 0)
+        data_dm = data_block - data_mean[np.newaxis,:]
+        data_norm = np.linalg.norm(data_dm, axis = 0)
+        data_valid = data_norm > 0
+        data_z = np.zeros(data_dm.shape)
+        data_z[:,data_valid] = data_dm[:,data_valid]/data_norm[data_valid]
+
+        # correlate every grid point with every vertex
+        corr = pred_z.dot(data_z)
+        best_idx = np.argmax(corr**2, axis = 0)
+        best_corr = corr[best_idx, np.arange(best_idx.shape[0])]
+
+        # closed-form amplitude and baseline
+        best_norm = pred_norm[best_idx]
+        beta = np.zeros(best_idx.shape[0])
+        beta[best_norm > 0] = best_corr[best_norm > 0] * data_norm[best_norm > 0] / best_norm[best_norm > 0]
+        baseline = data_mean - beta * pred_mean[best_idx]
+
+        ballpark[block_start:block_end,:-2] = grid_points[best_idx,:]
+        ballpark[block_start:block_end,-2] = beta
+        ballpark[block_start:block_end,-1] = baseline
+        rsq[block_start:block_end] = best_corr**2
+
+    return ballpark, rsq
+
+def fit_vertex(bundle):
+    """
+    Bounded optimization of a single vertex starting from its grid search ballpark
+
+    Parameters
+    ----------
+    bundle: tuple (data, ballpark, bounds, vertex_index),
+            fitted with the model given to the worker by init_fit_worker
+
+    Returns
+    -------
+    vertex_index: vertex index given in bundle
+    estimate: fitted parameters (grid parameters + beta + baseline)
+    rsq: r-square of the fitted prediction
+    fit_time: wall time of the vertex fit (s)
+    """
+
+    import popeye.utilities as utils
+
+    data, ballpark, bounds, vertex_index = bundle
+    model_func = worker_model_func
+    fit_start = time.perf_counter()
+
+    estimate = utils.gradient_descent_search(   data,
+                                                utils.error_function,
+                                                model_func.generate_prediction,
+                                                ballpark,
+                                                bounds,
+                                                0)[0]
+    prediction = model_func.generate_prediction(*estimate)
+    rsq = np.corrcoef(data, prediction)[0][1]**2
+
+    return vertex_index, estimate, rsq, time.perf_counter() - fit_start
+
+def prediction_bank_key(fit_model, visual_dm, analysis_info, grid_points, fit_model_bounds, hrf_model):
+    """
+    Hash all inputs defining the grid predictions
+
+    Parameters
+    ----------
+    fit_model: fit model ('gauss','css')
+    visual_dm: stimulus design matrix
+    analysis_info: analysis settings (screen geometry and TR)
+    grid_points: array (grid points x grid parameters)
+    fit_model_bounds: tuple of (min, max) search bounds per parameter
+    hrf_model: hrf function (e.g. popeye.utilities.spm_hrf)
+
+    Returns
+    -------
+    bank_key: hexadecimal hash string
+    """
+
+    import hashlib
+
+    key_hash = hashlib.sha1()
+    key_hash.update(fit_model.encode())
+    key_hash.update(np.ascontiguousarray(visual_dm).tobytes())
+    key_hash.update(str(visual_dm.shape).encode())
+    key_hash.update(json.dumps([ analysis_info['TR'],
+                                analysis_info['screen_distance'],
+                                analysis_info['screen_width']]).encode())
+    key_hash.update(np.ascontiguousarray(grid_points, dtype = np.float64).tobytes())
+    key_hash.update(json.dumps(fit_model_bounds).encode())
+    key_hash.update('{}.{}'.format(hrf_model.__module__, hrf_model.__name__).encode())
+    key_hash.update(np.ascontiguousarray(hrf_model(0, analysis_info['TR']), dtype = np.float64).tobytes())
+    bank_key = key_hash.hexdigest()
+
+    return bank_key
+
+def load_prediction_bank(bank_dir, bank_key, model_func, grid_points):
+    """
+    Open grid predictions from the on-disk bank as a read-only memory map,
+    building them first if no bank matches the inputs key
+
+    Parameters
+    ----------
+    bank_dir: absolute path to prediction bank directory
+    bank_key: hash of the prediction inputs (see prediction_bank_key)
+    model_func: popeye model used to build a missing bank
+    grid_points: array (grid points x grid parameters)
+
+    Returns
+    -------
+    predictions: read-only memory-mapped array (grid points x time points)
+    """
+
+    bank_file = os.path.join(bank_dir, 'predictions_{}.npy'.format(bank_key))
+
+    if not os.path.isfile(bank_file):
+        try: os.makedirs(bank_dir)
+        except OSError: pass
+
+        print('building prediction bank %s'%bank_file)
+        predictions = make_grid_predictions(model_func, grid_points)
+
+        # write under temporary name so concurrent jobs never open a partial bank
+        tmp_file = bank_file[:-4] + '_{}_{}.tmp.npy'.format(os.uname()[1], os.getpid())
+        np.save(tmp_file, predictions)
+        os.replace(tmp_file, bank_file)
+
+    predictions = np.load(bank_file, mmap_mode = 'r')
+
+    return predictions
+
+def warm_start_vertex(bundle):
+    """
+    Score reference pRF parameters (e.g. from group subject '999999')
+    as starting point of a single vertex
+
+    Parameters
+    ----------
+    bundle: tuple (data, ref_params, vertex_index) with ref_params the reference
+            grid parameters of the vertex, scored with the model given to the
+            worker by init_fit_worker
+
+    Returns
+    -------
+    vertex_index: vertex index given in bundle
+    ballpark: starting point (grid parameters + beta + baseline)
+    rsq: r-square of the starting point
+    """
+
+    data, ref_params, vertex_index = bundle
+    model_func = worker_model_func
+
+    if np.all(np.isfinite(ref_params)):
+        prediction = np.nan_to_num(model_func.generate_prediction(*ref_params, 1.0, 0.0))
+        ballpark, rsq = grid_search_batch(  predictions = prediction[np.newaxis,:],
+                                            grid_points = ref_params[np.newaxis,:],
+                                            data = data[:,np.newaxis])
+        ballpark, rsq = ballpark[0,:], rsq[0]
+    else:
+        ballpark, rsq = np.zeros(ref_params.shape[0] + 2), 0.0
+
+    return vertex_index, ballpark, rsq
+
+def load_gii_columns(gii_file, start_idx, end_idx):
+    """
+    Load vertex columns of all data arrays of a gifti file,
+    without keeping the other columns in memory
+
+    Parameters
+    ----------
+    gii_file: absolute path to gifti file
+    start_idx: first vertex index
+    end_idx: last vertex index, excluded (None for last vertex)
+
+    Returns
+    -------
+    data: array (data arrays x vertices)
+    gii_header: gifti header
+    gii_extra: gifti extra
+    """
+
+    import nibabel as nb
+
+    gii_load = nb.load(gii_file)
+    vox_num = gii_load.darrays[0].data[start_idx:end_idx].shape[0]
+    data = np.zeros((len(gii_load.darrays), vox_num), dtype = gii_load.darrays[0].data.dtype)
+    for i in range(len(gii_load.darrays)):
+        data[i,:] = gii_load.darrays[i].data[start_idx:end_idx]
+        gii_load.darrays[i].data = None
+    gii_header, gii_extra = gii_load.header, gii_load.extra
+
+    return data, gii_header, gii_extra
+
+def create_ledger_blocks(ledger_dir, blocks):
+    """
+    Add vertex blocks to the fit lease ledger
+
+    Parameters
+    ----------
+    ledger_dir: absolute path to ledger directory
+    blocks: list of dict with keys subject, hemi, fit_model, data_file,
+            start_idx, end_idx, output_file
+
+    Returns
+    -------
+    num_new: number of blocks added to the ledger
+    """
+
+    try: os.makedirs(ledger_dir)
+    except OSError: pass
+
+    num_new = 0
+    for block in blocks:
+        block_file = os.path.join(ledger_dir, '{subject}_{hemi}_{start_idx}_to_{end_idx}.block'.format(**block))
+        if os.path.isfile(block_file): continue
+        with open(block_file + '.tmp', 'w') as f:
+            json.dump(block, f)
+        os.replace(block_file + '.tmp', block_file)
+        num_new += 1
+
+    return num_new
+
+def ledger_blocks(ledger_dir, subject = None, hemi = None):
+    """
+    List blocks of the fit lease ledger with their state
+
+    Parameters
+    ----------
+    ledger_dir: absolute path to ledger directory
+    subject: only list blocks of this subject (optional)
+    hemi: only list blocks of this hemisphere (optional)
+
+    Returns
+    -------
+    blocks: list of block dict with additional keys block_file and
+            state ('todo','leased','expired','done','failed')
+    """
+
+    import glob
+
+    blocks = []
+    if not os.path.isdir(ledger_dir): return blocks
+
+    for block_file in sorted(glob.glob(os.path.join(ledger_dir, '*.block'))):
+        with open(block_file) as f:
+            block = json.load(f)
+        if subject is not None and block['subject'] != subject: continue
+        if hemi is not None and block['hemi'] != hemi: continue
+
+        block['block_file'] = block_file
+        if os.path.isfile(block_file[:-6] + '.done'):
+            block['state'] = 'done'
+        elif block.get('failed', False):
+            block['state'] = 'failed'
+        elif os.path.isfile(block_file[:-6] + '.lease'):
+            try:
+                with open(block_file[:-6] + '.lease') as f:
+                    lease = json.load(f)
+                block['state'] = 'leased' if lease['expiry'] > time.time() else 'expired'
+            except (OSError, ValueError):
+                block['state'] = 'leased'
+        else:
+            block['state'] = 'todo'
+        blocks.append(block)
+
+    return blocks
+
+def lease_block(ledger_dir, lease_dur, break_timeout = 300):
+    """
+    Take the lease of the next block to fit, re-issuing expired leases
+    and skipping done and failed blocks
+
+    Parameters
+    ----------
+    ledger_dir: absolute path to ledger directory
+    lease_dur: lease duration in seconds
+    break_timeout: age in seconds after which the break lock of a killed worker is removed
+
+    Returns
+    -------
+    block: leased block dict (None if no block is left to lease)
+    """
+
+    for block in ledger_blocks(ledger_dir):
+        if block['state'] in ['done','leased','failed']: continue
+        lease_file = block['block_file'][:-6] + '.lease'
+
+        # break expired lease under a per-block lock, so that a fresh lease
+        # of another worker is never moved away
+        if block['state'] == 'expired':
+            break_file = block['block_file'][:-6] + '.break'
+            try:
+                if time.time() - os.path.getmtime(break_file) > break_timeout: os.remove(break_file)
+            except OSError: pass
+            try: break_fd = os.open(break_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError: continue
+            try:
+                os.close(break_fd)
+                try:
+                    with open(lease_file) as f:
+                        lease = json.load(f)
+                except (OSError, ValueError): continue
+                if lease['expiry'] > time.time(): continue
+
+                # take over the expired lease and check it is the record read above
+                expired_file = lease_file + '.expired.{}.{}'.format(os.uname()[1], os.getpid())
+                try: os.rename(lease_file, expired_file)
+                except OSError: continue
+                with open(expired_file) as f:
+                    if json.load(f) != lease:
+                        os.rename(expired_file, lease_file)
+                        continue
+                os.remove(expired_file)
+
+                try: lease_fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except OSError: continue
+            finally:
+                os.remove(break_file)
+        else:
+            try: lease_fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError: continue
+
+        with os.fdopen(lease_fd, 'w') as f:
+            json.dump({'host': os.uname()[1], 'pid': os.getpid(), 'expiry': time.time() + lease_dur}, f)
+        return block
+
+    return None
+
+def renew_lease(block, lease_dur, break_timeout = 300):
+    """
+    Extend the lease of a block still being fitted, under the per-block lock
+    of lease_block so that a lease taken over by another worker is never
+    taken back
+
+    Parameters
+    ----------
+    block: leased block dict
+    lease_dur: lease duration in seconds from now
+    break_timeout: age in seconds after which the break lock of a killed worker is removed
+
+    Returns
+    -------
+    renewed: False if the lease is no longer held by this worker
+    """
+
+    lease_file = block['block_file'][:-6] + '.lease'
+    break_file = block['block_file'][:-6] + '.break'
+    while True:
+        try:
+            if time.time() - os.path.getmtime(break_file) > break_timeout: os.remove(break_file)
+        except OSError: pass
+        try:
+            os.close(os.open(break_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError: time.sleep(1)
+
+    try:
+        try:
+            with open(lease_file) as f:
+                lease = json.load(f)
+        except (OSError, ValueError): return False
+        if lease['host'] != os.uname()[1] or lease['pid'] != os.getpid(): return False
+
+        lease_tmp = lease_file + '.tmp.{}.{}'.format(os.uname()[1], os.getpid())
+        with open(lease_tmp, 'w') as f:
+            json.dump({'host': os.uname()[1], 'pid': os.getpid(), 'expiry': time.time() + lease_dur}, f)
+        os.replace(lease_tmp, lease_file)
+    finally:
+        os.remove(break_file)
+
+    return True
+
+def release_block(block, done, max_attempts = 3):
+    """
+    Give back a leased block, marking it done, open for re-issue or failed
+    once its fit failed max_attempts times (attempts counted in the block file)
+
+    Parameters
+    ----------
+    block: leased block dict
+    done: True if the block output file was written
+    max_attempts: number of failed fits after which the block is no longer leased
+
+    Returns
+    -------
+    state: new block state ('done','todo','failed')
+    """
+
+    lease_file = block['block_file'][:-6] + '.lease'
+    if done:
+        state = 'done'
+        with open(block['block_file'][:-6] + '.done', 'w') as f:
+            json.dump({ 'host': os.uname()[1], 'time': time.time(),
+                        'output_size': os.path.getsize(block['output_file'])}, f)
+    else:
+        # block file only rewritten by the lease holder
+        block_info = {key: val for key, val in block.items() if key not in ['block_file','state']}
+        block_info['attempts'] = block_info.get('attempts', 0) + 1
+        block_info['failed'] = block_info['attempts'] >= max_attempts
+        state = 'failed' if block_info['failed'] else 'todo'
+        block_tmp = block['block_file'] + '.tmp.{}.{}'.format(os.uname()[1], os.getpid())
+        with open(block_tmp, 'w') as f:
+            json.dump(block_info, f)
+        os.replace(block_tmp, block['block_file'])
+    try: os.remove(lease_file)
+    except OSError: pass
+
+    return state
+
+def load_checkpoint(ckpt_file, num_est):
+    """
+    Read vertices already fitted by an interrupted job
+
+    Parameters
+    ----------
+    ckpt_file: absolute path to checkpoint file
+    num_est: number of estimates per vertex (fit parameters + r-square)
+
+    Returns
+    -------
+    ckpt_vertex: array of fitted vertex indices
+    ckpt_estimates: array (fitted vertices x num_est) of estimates
+    """
+
+    record_size = num_est + 1
+    if not os.path.isfile(ckpt_file):
+        return np.zeros(0, dtype = int), np.zeros((0, num_est))
+
+    record_bytes = record_size * np.dtype(np.float64).itemsize
+    num_records = os.path.getsize(ckpt_file) // record_bytes
+
+    # drop record cut by the job kill so that new records stay aligned
+    if os.path.getsize(ckpt_file) != num_records * record_bytes:
+        os.truncate(ckpt_file, num_records * record_bytes)
+
+    ckpt = np.fromfile(ckpt_file, dtype = np.float64)
+
+    ckpt = ckpt[:num_records * record_size].reshape((num_records, record_size))
+    ckpt_vertex = ckpt[:,0].astype(int)
+    ckpt_estimates = ckpt[:,1:]
+
+    return ckpt_vertex, ckpt_estimates
+
+def append_checkpoint(ckpt, vertex_index, estimate, rsq):
+    """
+    Stream the fit of a vertex to the checkpoint file
+
+    Parameters
+    ----------
+    ckpt: checkpoint file object opened in 'ab' mode
+    vertex_index: vertex index
+    estimate: fitted parameters
+    rsq: r-square of the fit
+    """
+
+    record = np.hstack((vertex_index, estimate, rsq)).astype(np.float64)
+    ckpt.write(record.tobytes())
+    ckpt.flush()
+
+    return None
+
+def file_checksum(file_name):
+    """
+    Compute sha1 checksum of a file
+
+    Parameters
+    ----------
+    file_name: absolute path to file
+
+    Returns
+    -------
+    checksum: hexadecimal sha1 string
+    """
+
+    import hashlib
+
+    checksum = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2**24), b''):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+def opj_tmp(folder, file_name):
+    """
+    Define a process-unique temporary path for file_name in folder
+    """
+
+    return os.path.join(folder, '.{}.{}.{}.tmp'.format(file_name, os.uname()[1], os.getpid()))
+
+def convert_gii_to_store(data_file):
+    """
+    Convert a time-series gifti file into a vertex-major binary store
+    that can be memory-mapped by vertex slices
+
+    Parameters
+    ----------
+    data_file: absolute path to time-series gifti file
+
+    Returns
+    -------
+    store_dir: absolute path to store directory (data_file without .gii + '_store')
+               with data.npy (vertices x time points), header.gii and store.json
+    """
+
+    import nibabel as nb
+
+    store_dir = data_file[:-4] + '_store'
+    try: os.makedirs(store_dir)
+    except OSError: pass
+
+    data_file_load = nb.load(data_file)
+    data = np.zeros((data_file_load.darrays[0].data.shape[0], len(data_file_load.darrays)),
+                    dtype = data_file_load.darrays[0].data.dtype)
+    for i in range(len(data_file_load.darrays)):
+        data[:,i] = data_file_load.darrays[i].data
+    with open(opj_tmp(store_dir, 'data.npy'), 'wb') as f:
+        np.save(f, data)
+    os.replace(opj_tmp(store_dir, 'data.npy'), os.path.join(store_dir, 'data.npy'))
+
+    # keep header for outputs written from the store
+    gii_header = nb.gifti.gifti.GiftiImage(header = data_file_load.header, extra = data_file_load.extra)
+    nb.save(gii_header, os.path.join(store_dir, 'header.gii'))
+
+    # store description written last: its presence marks a complete store
+    store_info = {  'source': data_file,
+                    'source_sha1': file_checksum(data_file),
+                    'source_size': os.path.getsize(data_file),
+                    'source_mtime': os.path.getmtime(data_file),
+                    'ts_num': data.shape[1],
+                    'vox_num': data.shape[0],
+                    'dtype': str(data.dtype)}
+    with open(opj_tmp(store_dir, 'store.json'), 'w') as f:
+        json.dump(store_info, f)
+    os.replace(opj_tmp(store_dir, 'store.json'), os.path.join(store_dir, 'store.json'))
+
+    return store_dir
+
+def ts_store_info(data_file):
+    """
+    Get description of the binary store of a time-series gifti file
+    if it is up to date with the gifti file
+
+    Parameters
+    ----------
+    data_file: absolute path to time-series gifti file
+
+    Returns
+    -------
+    store_info: dict with store_dir, ts_num, vox_num and dtype (None if no valid store)
+    """
+
+    store_dir = data_file[:-4] + '_store'
+    try:
+        with open(os.path.join(store_dir, 'store.json')) as f:
+            store_info = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # size and time check first, checksum only when they changed
+    if os.path.getsize(data_file) != store_info['source_size']: return None
+    if os.path.getmtime(data_file) != store_info['source_mtime']:
+        if file_checksum(data_file) != store_info['source_sha1']: return None
+
+        # same content (e.g. copy or touch): keep new time so next jobs skip the checksum
+        store_info['source_mtime'] = os.path.getmtime(data_file)
+        try:
+            with open(opj_tmp(store_dir, 'store.json'), 'w') as f:
+                json.dump(store_info, f)
+            os.replace(opj_tmp(store_dir, 'store.json'), os.path.join(store_dir, 'store.json'))
+        except OSError: pass
+
+    store_info['store_dir'] = store_dir
+
+    return store_info
+
+def load_ts_columns(data_file, start_idx = None, end_idx = None):
+    """
+    Load vertex columns of a time series, from its binary store when up to date,
+    from its gifti file otherwise
+
+    Parameters
+    ----------
+    data_file: absolute path to time-series gifti file
+    start_idx: first vertex index (default: 0)
+    end_idx: last vertex index, excluded (default: number of vertices)
+
+    Returns
+    -------
+    data: array (time points x vertices)
+    gii_header: gifti header
+    gii_extra: gifti extra
+    """
+
+    import nibabel as nb
+
+    if start_idx is None: start_idx = 0
+    store_info = ts_store_info(data_file)
+    if store_info is None:
+        return load_gii_columns(data_file, start_idx, end_idx)
+
+    if end_idx is None: end_idx = store_info['vox_num']
+    data_store = np.load(os.path.join(store_info['store_dir'], 'data.npy'), mmap_mode = 'r')
+    data = np.array(data_store[start_idx:end_idx,:].T)
+    gii_load = nb.load(os.path.join(store_info['store_dir'], 'header.gii'))
+
+    return data, gii_load.header, gii_load.extra
+
+def ts_shape(data_file):
+    """
+    Get number of time points and vertices of a time-series gifti file
+
+    Parameters
+    ----------
+    data_file: absolute path to time-series gifti file
+
+    Returns
+    -------
+    ts_num: number of time points
+    vox_num: number of vertices
+    """
+
+    import nibabel as nb
+
+    store_info = ts_store_info(data_file)
+    if store_info is None:
+        data_file_load = nb.load(data_file)
+        return len(data_file_load.darrays), data_file_load.darrays[0].data.shape[0]
+
+    return store_info['ts_num'], store_info['vox_num']
+
+def open_manifest(manifest_file):
+    """
+    Open the dataset manifest listing data files, shapes and fit slices,
+    creating it if needed
+
+    Parameters
+    ----------
+    manifest_file: absolute path to sqlite manifest file
+
+    Returns
+    -------
+    manifest: sqlite3 connection
+    """
+
+    import sqlite3
+
+    try: os.makedirs(os.path.dirname(manifest_file))
+    except OSError: pass
+
+    # shared file systems: wait for locks instead of failing at once
+    manifest = sqlite3.connect(manifest_file, timeout = 120)
+    manifest.execute("PRAGMA busy_timeout = 120000")
+    manifest_write(manifest, ["""CREATE TABLE IF NOT EXISTS data_files (
+                                    subject TEXT, hemi TEXT, data_file TEXT, ts_num INTEGER, vox_num INTEGER,
+                                    dtype TEXT, size INTEGER, mtime REAL, PRIMARY KEY (subject, hemi))""",
+                                """CREATE TABLE IF NOT EXISTS fit_chunks (
+                                    subject TEXT, hemi TEXT, fit_model TEXT, start_idx INTEGER, end_idx INTEGER,
+                                    output_file TEXT, done INTEGER, size INTEGER, mtime REAL,
+                                    PRIMARY KEY (subject, hemi, fit_model, start_idx, end_idx))""",
+                                "CREATE INDEX IF NOT EXISTS fit_chunks_file ON fit_chunks (output_file)"])
+
+    return manifest
+
+def manifest_write(manifest, queries, num_try = 10):
+    """
+    Run write queries of the manifest in one transaction, retrying while the
+    database is locked by another job (sqlite locks are unreliable on NFS,
+    only submit, scan and merge steps write to the manifest)
+
+    Parameters
+    ----------
+    manifest: sqlite3 connection (see open_manifest)
+    queries: list of query strings or (query, list of argument tuples) pairs
+    num_try: number of attempts before raising the lock error
+    """
+
+    import sqlite3
+    import random
+
+    for num in range(num_try):
+        try:
+            for query in queries:
+                if isinstance(query, str): manifest.execute(query)
+                else: manifest.executemany(query[0], query[1])
+            manifest.commit()
+            return None
+        except sqlite3.OperationalError as error:
+            manifest.rollback()
+            if 'locked' not in str(error) or num == num_try - 1: raise
+            print('manifest locked, retrying (%s)'%error)
+            time.sleep(random.uniform(1, 2) * np.min((2**num, 60)))
+
+    return None
+
+def manifest_data_shape(manifest, subject, hemi, data_file):
+    """
+    Get number of time points and vertices of a subject hemisphere from the manifest,
+    reading and registering them on first use
+
+    Parameters
+    ----------
+    manifest: sqlite3 connection (see open_manifest)
+    subject: subject name
+    hemi: brain hemisphere
+    data_file: absolute path to time-series gifti file
+
+    Returns
+    -------
+    ts_num: number of time points
+    vox_num: number of vertices
+    """
+
+    row = manifest.execute("SELECT ts_num, vox_num FROM data_files WHERE subject = ? AND hemi = ?",
+                            (subject, hemi)).fetchone()
+    if row is not None: return row[0], row[1]
+
+    ts_num, vox_num = ts_shape(data_file)
+    store_info = ts_store_info(data_file)
+    dtype = store_info['dtype'] if store_info is not None else 'float32'
+    manifest_write(manifest, [("INSERT OR REPLACE INTO data_files VALUES (?,?,?,?,?,?,?,?)",
+                                [(subject, hemi, data_file, ts_num, vox_num, dtype,
+                                  os.path.getsize(data_file), os.path.getmtime(data_file))])])
+
+    return ts_num, vox_num
+
+def manifest_register_chunks(manifest, subject, hemi, fit_model, chunks):
+    """
+    Register fit slices of a subject hemisphere in the manifest
+
+    Parameters
+    ----------
+    manifest: sqlite3 connection (see open_manifest)
+    subject: subject name
+    hemi: brain hemisphere
+    fit_model: fit model ('gauss','css')
+    chunks: list of (start_idx, end_idx, output_file)
+    """
+
+    manifest_write(manifest, [("INSERT OR IGNORE INTO fit_chunks VALUES (?,?,?,?,?,?,0,0,0)",
+                                [(subject, hemi, fit_model, int(start_idx), int(end_idx), output_file)
+                                    for start_idx, end_idx, output_file in chunks])])
+
+    return None
+
+def manifest_update_chunk(manifest, output_file):
+    """
+    Record state and size of fit slice files in the manifest
+
+    Parameters
+    ----------
+    manifest: sqlite3 connection (see open_manifest)
+    output_file: absolute path to fit slice file, or list of paths
+    """
+
+    if isinstance(output_file, str): output_file = [output_file]
+    chunk_states = []
+    for chunk_file in output_file:
+        if os.path.isfile(chunk_file):
+            size, mtime = os.path.getsize(chunk_file), os.path.getmtime(chunk_file)
+        else:
+            size, mtime = 0, 0
+        chunk_states.append((int(size != 0), size, mtime, chunk_file))
+    manifest_write(manifest, [("UPDATE fit_chunks SET done = ?, size = ?, mtime = ? WHERE output_file = ?", chunk_states)])
+
+    return None
+
+def manifest_refresh_chunks(manifest, subject, fit_model, hemi = None):
+    """
+    Record in the manifest the slices written by fit jobs since last refresh
+    (fit jobs do not write to the manifest) and list the slices
+
+    Parameters
+    ----------
+    manifest: sqlite3 connection (see open_manifest)
+    subject: subject name
+    fit_model: fit model ('gauss','css')
+    hemi: only refresh slices of this hemisphere (optional)
+
+    Returns
+    -------
+    chunks: list of dict as returned by manifest_chunks
+    """
+
+    todo_files = [chunk['output_file'] for chunk in manifest_chunks(manifest, subject, fit_model, hemi)
+                    if not chunk['done'] and os.path.isfile(chunk['output_file'])]
+    if len(todo_files) > 0: manifest_update_chunk(manifest, todo_files)
+
+    return manifest_chunks(manifest, subject, fit_model, hemi)
+
+def manifest_chunks(manifest, subject, fit_model, hemi = None):
+    """
+    List fit slices of a subject registered in the manifest
+
+    Parameters
+    ----------
+    manifest: sqlite3 connection (see open_manifest)
+    subject: subject name
+    fit_model: fit model ('gauss','css')
+    hemi: only list slices of this hemisphere (optional)
+
+    Returns
+    -------
+    chunks: list of dict with keys hemi, start_idx, end_idx, output_file, done and size
+    """
+
+    query = "SELECT hemi, start_idx, end_idx, output_file, done, size FROM fit_chunks WHERE subject = ? AND fit_model = ?"
+    query_args = [subject, fit_model]
+    if hemi is not None:
+        query += " AND hemi = ?"
+        query_args.append(hemi)
+    query += " ORDER BY hemi, start_idx"
+
+    chunks = [dict(zip(['hemi','start_idx','end_idx','output_file','done','size'], row))
+                for row in manifest.execute(query, query_args)]
+
+    return chunks
+
+def triage_vertices(data, mask = None):
+    """
+    Detect vertices that can give a valid pRF fit
+
+    Parameters
+    ----------
+    data: array (time points x vertices)
+    mask: boolean array (vertices) of atlas vertices to fit, e.g. excluding
+          the medial wall (optional)
+
+    Returns
+    -------
+    fittable: boolean array (vertices), False for vertices with nan or
+              constant time course or outside of mask
+    """
+
+    fittable = np.all(np.isfinite(data), axis = 0)
+    fittable[fittable] = np.ptp(data[:,fittable], axis = 0) > 0
+    if mask is not None:
+        fittable = fittable & mask
+
+    return fittable
+
+def load_triage_mask(mask_file, start_idx = None, end_idx = None):
+    """
+    Load atlas mask of vertices to fit
+
+    Parameters
+    ----------
+    mask_file: absolute path to mask gifti file (first data array non-zero for vertices to fit),
+               None or empty string for no mask
+    start_idx: first vertex index (default: 0)
+    end_idx: last vertex index, excluded (default: number of vertices)
+
+    Returns
+    -------
+    mask: boolean array (vertices), None if no mask file
+    """
+
+    if not mask_file: return None
+    if start_idx is None: start_idx = 0
+    mask = load_gii_columns(mask_file, start_idx, end_idx)[0][0,:] != 0
+
+    return mask
+
+def balance_chunks(fittable, job_vox):
+    """
+    Cut a hemisphere in slices holding a similar number of fittable vertices
+
+    Parameters
+    ----------
+    fittable: boolean array (vertices) of vertices to fit
+    job_vox: number of fittable vertices per slice
+
+    Returns
+    -------
+    start_idx: array of first vertex index of each slice
+    end_idx: array of last vertex index (excluded) of each slice
+    """
+
+    num_chunks = int(np.max((np.ceil(fittable.sum()/float(job_vox)), 1)))
+    fittable_idx = np.where(fittable)[0]
+    cut_idx = [fittable_idx[int(np.round(num_chunk*fittable_idx.shape[0]/num_chunks))] for num_chunk in np.arange(1,num_chunks,1)]
+    start_idx = np.hstack((0, cut_idx)).astype(int)
+    end_idx = np.hstack((cut_idx, fittable.shape[0])).astype(int)
+
+    return start_idx, end_idx
+
+def stage_log_file(base_dir, subject, fit_model):
+    """
+    Define the stage timing log of a subject, next to its job logs
+
+    Parameters
+    ----------
+    base_dir: main directory
+    subject: subject name
+    fit_model: fit model ('gauss','css')
+
+    Returns
+    -------
+    log_file: absolute path to json lines file
+    """
+
+    return os.path.join(base_dir,'pp_data',subject,fit_model,'log_outputs','stage_timing.jsonl')
+
+def rss_lifetime_peak_mb(children = False):
+    """
+    Peak resident memory reached so far by this process or by its waited-for children
+    (ru_maxrss, in kB on linux and in bytes on macOS)
+
+    Parameters
+    ----------
+    children: peak of the largest child process instead of this process
+
+    Returns
+    -------
+    rss_mb: peak resident memory in MB since the process start
+    """
+
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin': return rss/1024.0**2
+    return rss/1024.0
+
+@contextlib.contextmanager
+def log_stage(log_file, stage, **info):
+    """
+    Record wall time, cpu time and peak memory of a pipeline stage
+    as one json line appended to log_file. Peak memory is the process lifetime
+    peak (rss_lifetime_peak_mb), rss_peak_growth_mb being its growth during
+    the stage (0 when the stage stays below an earlier peak)
+
+    Parameters
+    ----------
+    log_file: absolute path to json lines file (see stage_log_file)
+    stage: stage name
+    info: extra fields of the record (e.g. subject, hemi, fit_model, start_idx)
+
+    Yields
+    ------
+    record: dict in which the stage can set 'vertices' (number of vertices processed)
+            and 'vertex_times' (array of per-vertex fit times in s)
+    """
+
+    record = {'vertices': None, 'vertex_times': None}
+    rss_start = rss_lifetime_peak_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    status = 'failed'
+    try:
+        yield record
+        status = 'done'
+    finally:
+        wall = time.perf_counter() - wall_start
+        vertex_times = record.pop('vertex_times')
+        record.update(info)
+        record.update({ 'stage': stage,
+                        'status': status,
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'host': platform.uname()[1],
+                        'pid': os.getpid(),
+                        'wall_s': wall,
+                        'cpu_s': time.process_time() - cpu_start,
+                        'rss_lifetime_peak_mb': rss_lifetime_peak_mb(),
+                        'rss_peak_growth_mb': rss_lifetime_peak_mb() - rss_start,
+                        'rss_children_lifetime_peak_mb': rss_lifetime_peak_mb(children = True)})
+        if record['vertices'] is not None:
+            record['vertices'] = int(record['vertices'])
+            record['vertices_per_s'] = record['vertices']/wall if wall > 0 else None
+
+        # per-vertex fit times: worker cpu sum and log10 histogram
+        if vertex_times is not None and len(vertex_times) > 0:
+            vertex_times = np.asarray(vertex_times, dtype = np.float64)
+            log_times = np.clip(np.log10(np.maximum(vertex_times, 1e-9)), vertex_time_bins[0], vertex_time_bins[-1])
+            record['vertex_time_sum_s'] = float(np.sum(vertex_times))
+            record['vertex_time_median_s'] = float(np.median(vertex_times))
+            record['vertex_time_hist'] = np.histogram(log_times, bins = vertex_time_bins)[0].tolist()
+
+        # one write per record so that concurrent jobs append whole lines
+        try: os.makedirs(os.path.split(log_file)[0])
+        except OSError: pass
+        with open(log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def read_stage_logs(log_files):
+    """
+    Read stage timing records of many jobs
+
+    Parameters
+    ----------
+    log_files: list of json lines files written by log_stage
+
+    Returns
+    -------
+    records: list of record dicts (lines cut by a job kill are skipped)
+    """
+
+    records = []
+    for log_file in log_files:
+        with open(log_file) as f:
+            for line in f:
+                try: records.append(json.loads(line))
+                except ValueError: continue
+
+    return records
+
+def setup_fit(fit_model, base_dir, analysis_info):
+    """
+    Load stimulus and build the popeye model with its search grids and bounds
+
+    Parameters
+    ----------
+    fit_model: fit model ('gauss','css')
+    base_dir: main directory (with raw_data/retinotopysmall5.mat)
+    analysis_info: analysis settings
+
+    Returns
+    -------
+    fit_setup: dict with keys fit_model, model_func, fit_func, num_est,
+               visual_dm, grids and bounds
+    """
+
+    import scipy.io
+    import popeye.utilities as utils
+    from popeye.visual_stimulus import VisualStimulus
+    import popeye.css as css
+    import popeye.og as og
+
+    # Create stimulus design
+    visual_dm_file = scipy.io.loadmat(os.path.join(base_dir,'raw_data','retinotopysmall5.mat'))
+    visual_dm = visual_dm_file['stim']
+
+    stimulus = VisualStimulus(  stim_arr = visual_dm,
+                                viewing_distance = analysis_info["screen_distance"],
+                                screen_width = analysis_info["screen_width"],
+                                scale_factor = 1/10.0,
+                                tr_length = analysis_info["TR"],
+                                dtype = np.short)
+
+    # Initialize css model
+    if fit_model == 'gauss':
+        fit_func = og.GaussianFit
+        num_est = 6
+        model_func = og.GaussianModel(  stimulus = stimulus,
+                                        hrf_model = utils.spm_hrf)
+    elif fit_model == 'css':
+        fit_func = css.CompressiveSpatialSummationFit
+        num_est = 7
+        model_func = css.CompressiveSpatialSummationModel(  stimulus = stimulus,
+                                                            hrf_model = utils.spm_hrf)
+
+    model_func.hrf_delay = 0
+    print('models and stimulus loaded')
+
+    # Fit: define search grids
+    x_grid = (-12, 12)
+    y_grid = (-12, 12)
+    sigma_grid = (0.05, 15)
+    n_grid =  (0.01, 1.5)
+
+    # Fit: define search bounds
+    x_bound = (-30.0, 30.0)
+    y_bound = (-30.0, 30.0)
+    sigma_bound = (0.001, 70.0)
+    n_bound = (0.01, 3)
+    beta_bound = (-1e3, 1e3)
+    baseline_bound = (-1e3, 1e3)
+
+    if fit_model == 'gauss':
+        fit_model_grids =  (x_grid, y_grid, sigma_grid)
+        fit_model_bounds = (x_bound, y_bound, sigma_bound, beta_bound, baseline_bound)
+    elif fit_model == 'css':
+        fit_model_grids =  (x_grid, y_grid, sigma_grid, n_grid)
+        fit_model_bounds = (x_bound, y_bound, sigma_bound, n_bound, beta_bound, baseline_bound)
+
+    fit_setup = {   'fit_model': fit_model,
+                    'model_func': model_func,
+                    'fit_func': fit_func,
+                    'num_est': num_est,
+                    'visual_dm': visual_dm,
+                    'grids': fit_model_grids,
+                    'bounds': fit_model_bounds}
+
+    return fit_setup
+
+def init_fit_worker(model_func):
+    """
+    Give the popeye model to a pool worker once,
+    instead of sending it with every vertex
+
+    Parameters
+    ----------
+    model_func: popeye model
+    """
+
+    global worker_model_func
+    worker_model_func = model_func
+
+    return None
+
+def fit_slice(pool, fit_setup, subject, data_file, start_idx, end_idx, base_dir, analysis_info, warm_start_file = None):
+    """
+    Fit a slice of vertices of a subject hemisphere and save its estimates
+
+    Parameters
+    ----------
+    pool: multiprocessing pool started with init_fit_worker
+    fit_setup: fit model definition (see setup_fit)
+    subject: subject name
+    data_file: absolute path to time-series gifti file
+    start_idx: first vertex index
+    end_idx: last vertex index (excluded)
+    base_dir: main directory
+    analysis_info: analysis settings
+    warm_start_file: reference estimate file for warm start
+                     (default: merged fit of analysis_info['warm_start_subject'],
+                     batch grid search if missing or for that subject itself)
+
+    Returns
+    -------
+    opfn_est: absolute path to slice estimate gifti file
+    """
+
+    import nibabel as nb
+    import popeye.utilities as utils
+
+    fit_model = fit_setup['fit_model']
+    model_func = fit_setup['model_func']
+    num_est = fit_setup['num_est']
+    start_idx, end_idx = int(start_idx), int(end_idx)
+    Ns = analysis_info["fit_step"]
+
+    # Define output file path and directories
+    base_file_name = os.path.split(data_file)[-1][:-7]
+    hemi = base_file_name.split('.func_bla_psc')[0][-1]
+    opfn_est = os.path.join(base_dir,'pp_data',subject,fit_model,'fit',base_file_name + '_est_%s_to_%s.gii' %(start_idx,end_idx))
+    if warm_start_file is None:
+        warm_start_file = os.path.join(base_dir,'pp_data',analysis_info['warm_start_subject'],fit_model,'fit',base_file_name + '_est.gii')
+
+    # Warm start needs a merged reference fit of another subject
+    grid_search = analysis_info['fit_grid_search']
+    if grid_search == 'warm' and (subject == analysis_info['warm_start_subject'] or not os.path.isfile(warm_start_file)):
+        print('no warm start reference for %s (%s), falling back to batch grid search'%(subject, warm_start_file))
+        grid_search = 'batch'
+
+    try: os.makedirs(os.path.join(base_dir,'pp_data',subject,fit_model,'fit'))
+    except OSError: pass
+
+    # Stage timing log, next to job logs
+    log_file = stage_log_file(base_dir, subject, fit_model)
+    log_info = {'subject': subject, 'hemi': hemi, 'fit_model': fit_model,
+                'start_idx': start_idx, 'end_idx': end_idx, 'grid_search': grid_search}
+
+    # Load data
+    with log_stage(log_file, 'load', **log_info) as stage:
+        data_to_analyse, data_header, data_extra = load_ts_columns(    data_file = data_file,
+                                                                        start_idx = start_idx,
+                                                                        end_idx = end_idx)
+        stage['vertices'] = data_to_analyse.shape[1]
+
+    # Fit: define empty estimate of the slice and voxel indeces
+    estimates = np.zeros((num_est,data_to_analyse.shape[1]))
+    vertex_indices = [(xx, 0, 0) for xx in np.arange(start_idx,end_idx,1)]
+
+    # Resume from checkpoint of an interrupted job
+    ckpt_file = opfn_est[:-4] + '_checkpoint.bin'
+    ckpt_vertex, ckpt_estimates = load_checkpoint(ckpt_file, num_est)
+    estimates[:,ckpt_vertex - start_idx] = ckpt_estimates.T
+    todo_vox = np.setdiff1d(np.arange(0,data_to_analyse.shape[1],1), ckpt_vertex - start_idx)
+    print('%i vertices found in checkpoint, %i vertices to fit'%(ckpt_vertex.shape[0],todo_vox.shape[0]))
+    ckpt = open(ckpt_file, 'ab')
+
+    # Triage: no fit of nan, constant or masked out time courses
+    with log_stage(log_file, 'triage', **log_info) as stage:
+        if analysis_info['triage_mask']: triage_mask_file = os.path.join(base_dir,'raw_data',analysis_info['triage_mask'].format(hemi = hemi))
+        else: triage_mask_file = None
+        fittable = triage_vertices( data = data_to_analyse,
+                                    mask = load_triage_mask(triage_mask_file, start_idx, end_idx))
+        estimates[:,~fittable] = np.nan
+        todo_vox = todo_vox[fittable[todo_vox]]
+        stage['vertices'] = data_to_analyse.shape[1]
+    print('%i vertices skipped by triage'%np.sum(~fittable))
+
+    # Run fitting
+    if grid_search in ['batch','warm']:
+        ballpark = np.zeros((data_to_analyse.shape[1],num_est-1))
+        grid_vox = todo_vox
+
+        # Warm start: reference estimates as starting points
+        if grid_search == 'warm' and todo_vox.shape[0] > 0:
+            with log_stage(log_file, 'warm_start', **log_info) as stage:
+                ref_params = load_gii_columns(  gii_file = warm_start_file,
+                                                start_idx = start_idx,
+                                                end_idx = end_idx)[0][:num_est-3,:]
+                bundle = [(data_to_analyse[:,num_vox], ref_params[:,num_vox], num_vox)
+                            for num_vox in todo_vox]
+                output = pool.map(  func = warm_start_vertex,
+                                    iterable = bundle)
+
+                warm_rsq = np.zeros(data_to_analyse.shape[1])
+                for num_vox, vox_ballpark, vox_rsq in output:
+                    ballpark[num_vox,:] = vox_ballpark
+                    warm_rsq[num_vox] = vox_rsq
+                stage['vertices'] = todo_vox.shape[0]
+
+            # fall back to full grid for poor starting points
+            grid_vox = todo_vox[~(warm_rsq[todo_vox] >= analysis_info['warm_start_rsq_threshold'])]
+            print('warm start done: %i vertices sent to grid search'%grid_vox.shape[0])
+
+        # Grid search: all vertices of the job at once
+        if grid_vox.shape[0] > 0:
+            with log_stage(log_file, 'prediction_bank', **log_info):
+                grid_points = make_grid_points(fit_setup['grids'], Ns)
+                bank_key = prediction_bank_key( fit_model = fit_model,
+                                                visual_dm = fit_setup['visual_dm'],
+                                                analysis_info = analysis_info,
+                                                grid_points = grid_points,
+                                                fit_model_bounds = fit_setup['bounds'],
+                                                hrf_model = utils.spm_hrf)
+                predictions = load_prediction_bank( bank_dir = os.path.join(base_dir,'pp_data','prediction_bank'),
+                                                    bank_key = bank_key,
+                                                    model_func = model_func,
+                                                    grid_points = grid_points)
+            with log_stage(log_file, 'grid_search', **log_info) as stage:
+                ballpark[grid_vox,:], _ = grid_search_batch(predictions, grid_points, data_to_analyse[:,grid_vox])
+                stage['vertices'] = grid_vox.shape[0]
+            print('batch grid search done')
+
+        # Bounded optimization: vertex by vertex, streamed to checkpoint
+        with log_stage(log_file, 'optimize', **log_info) as stage:
+            bundle = [(data_to_analyse[:,num_vox], ballpark[num_vox,:], fit_setup['bounds'], vertex_indices[num_vox])
+                        for num_vox in todo_vox]
+            output = pool.imap_unordered(   func = fit_vertex,
+                                            iterable = bundle)
+
+            vertex_times = []
+            for vertex_index, estimate, rsq, fit_time in output:
+                estimates[:num_est-1,vertex_index[0] - start_idx] = estimate
+                estimates[num_est-1,vertex_index[0] - start_idx] = rsq
+                append_checkpoint(ckpt, vertex_index[0], estimate, rsq)
+                vertex_times.append(fit_time)
+            stage['vertices'] = len(vertex_times)
+            stage['vertex_times'] = vertex_times
+
+    elif grid_search == 'popeye':
+
+        # Grid search and optimization: vertex by vertex within popeye
+        with log_stage(log_file, 'optimize', **log_info) as stage:
+            bundle = utils.multiprocess_bundle( Fit = fit_setup['fit_func'],
+                                                model = model_func,
+                                                data = data_to_analyse[:,todo_vox].T,
+                                                grids = fit_setup['grids'],
+                                                bounds = fit_setup['bounds'],
+                                                indices = [vertex_indices[num_vox] for num_vox in todo_vox],
+                                                auto_fit = True,
+                                                verbose = 1,
+                                                Ns = Ns)
+            output = pool.imap_unordered(   func = utils.parallel_fit,
+                                            iterable = bundle)
+
+            for fit in output:
+                estimates[:num_est-1,fit.voxel_index[0] - start_idx] = fit.estimate
+                estimates[num_est-1,fit.voxel_index[0] - start_idx] = fit.rsquared
+                append_checkpoint(ckpt, fit.voxel_index[0], fit.estimate, fit.rsquared)
+            stage['vertices'] = todo_vox.shape[0]
+
+    else:
+        ckpt.close()
+        raise ValueError("unknown fit_grid_search '%s' (use 'batch', 'warm' or 'popeye')"%grid_search)
+
+    ckpt.close()
+
+    # Save estimates data once the slice is complete
+    with log_stage(log_file, 'save', **log_info) as stage:
+        darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in estimates]
+        gii_out = nb.gifti.gifti.GiftiImage(header = data_header,
+                                            extra = data_extra,
+                                            darrays = darrays)
+        nb.save(gii_out, opfn_est[:-4] + '_tmp.gii')
+        os.replace(opfn_est[:-4] + '_tmp.gii', opfn_est)
+        os.remove(ckpt_file)
+        stage['vertices'] = estimates.shape[1]
+
+    return opfn_est
@@ -29,11 +29,8 @@ import sys
 import json
 import glob
 import numpy as np
-import matplotlib.pyplot as pl
-import ipdb
 import platform
 opj = os.path.join
-deb = ipdb.set_trace
 
 # Define analysis parameters
 # --------------------------
@@ -0,0 +1,184 @@
+"""
+-----------------------------------------------------------------------------------------
+lease_fit_jobs.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Fit subjects with generic workers pulling vertex blocks from a shared lease ledger
+instead of static jobs per voxel slice
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: action ('init','work','submit','status')
+sys.argv[2]: fit model ('gauss','css')
+sys.argv[3]: init: fittable vertex per block (e.g. 400)
+             work: lease duration in hours (e.g. 1)
+             submit: number of workers to send (e.g. 50)
+sys.argv[4]: init: subject names (optional, default all subjects of settings.json)
+             submit: worker duration requested in hours (e.g. 10)
+-----------------------------------------------------------------------------------------
+Output(s):
+ledger files in pp_data/ledger/<fit_model> and fit gifti files per block
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python fit/lease_fit_jobs.py init gauss 400 192641 105923
+python fit/lease_fit_jobs.py submit gauss 50 10
+python fit/lease_fit_jobs.py work gauss 1
+python fit/lease_fit_jobs.py status gauss
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import numpy as np
+import os
+import glob
+import json
+import sys
+import time
+import subprocess
+import platform
+opj = os.path.join
+
+# Functions import
+from fit_utils import create_ledger_blocks, ledger_blocks, lease_block, renew_lease, release_block
+from fit_utils import open_manifest, manifest_data_shape, manifest_register_chunks
+from fit_utils import load_ts_columns, triage_vertices, load_triage_mask, balance_chunks
+
+# Get inputs
+action = sys.argv[1]
+fit_model = sys.argv[2]
+
+# Load the analysis parameters from json file
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+# Define server or cluster settings
+if 'lisa' in platform.uname()[1]:
+    jobscript_template_file = opj(os.getcwd(),'fit','lisa_worker_jobscript_template.sh')
+    base_dir = analysis_info['lisa_cluster_base_folder']
+elif 'aeneas' in platform.uname()[1]:
+    jobscript_template_file = None
+    base_dir = analysis_info['aeneas_base_folder']
+elif 'local' in platform.uname()[1]:
+    jobscript_template_file = None
+    base_dir = analysis_info['local_base_folder']
+
+fit_script = 'fit/prf_fit.py'
+ledger_dir = opj(base_dir,'pp_data','ledger',fit_model)
+
+if action == 'init':
+
+    # Cut each subject hemisphere in small blocks of vertices
+    block_vox = int(sys.argv[3])
+    if len(sys.argv) > 4: subjects = sys.argv[4:]
+    else: subjects = analysis_info['subject_list']
+
+    manifest = open_manifest(opj(base_dir,'pp_data','manifest.sqlite'))
+    blocks = []
+    for subject in subjects:
+        for hemi in ['L','R']:
+            data_file = sorted(glob.glob(opj(base_dir,'raw_data',subject,'*RETBAR1_7T*%s.func_bla_psc_av.gii'% hemi)))
+            base_file_name = os.path.split(data_file[0])[-1][:-7]
+
+            # blocks with similar number of fittable vertices
+            if analysis_info['triage_mask']: triage_mask_file = opj(base_dir,'raw_data',analysis_info['triage_mask'].format(hemi = hemi))
+            else: triage_mask_file = None
+            manifest_data_shape(manifest, subject, hemi, data_file[0])
+            fittable = triage_vertices( data = load_ts_columns(data_file[0])[0],
+                                        mask = load_triage_mask(triage_mask_file))
+
+            for start_idx, end_idx in zip(*balance_chunks(fittable, block_vox)):
+                blocks.append({ 'subject': subject,
+                                'hemi': hemi,
+                                'fit_model': fit_model,
+                                'data_file': data_file[0],
+                                'start_idx': int(start_idx),
+                                'end_idx': int(end_idx),
+                                'output_file': opj(base_dir,'pp_data',subject,fit_model,'fit',
+                                                    base_file_name + '_est_%i_to_%i.gii' %(start_idx,end_idx))})
+
+    num_new = create_ledger_blocks(ledger_dir, blocks)
+    for subject in subjects:
+        for hemi in ['L','R']:
+            manifest_register_chunks(manifest, subject, hemi, fit_model,
+                [(block['start_idx'], block['end_idx'], block['output_file']) for block in blocks
+                    if block['subject'] == subject and block['hemi'] == hemi])
+    print('%i new blocks added to %s'%(num_new,ledger_dir))
+
+elif action == 'work':
+
+    # Drain the ledger block by block
+    lease_dur = float(sys.argv[3])*3600
+    while True:
+        block = lease_block(ledger_dir, lease_dur)
+        if block is None:
+            print('no block left to fit in %s'%ledger_dir)
+            break
+
+        print('fitting %s %s vox num: %i to %i'%(block['subject'],block['hemi'],block['start_idx'],block['end_idx']))
+        try: os.makedirs(opj(base_dir,'pp_data',block['subject'],fit_model,'log_outputs'))
+        except OSError: pass
+
+        fit_cmd = ['python', fit_script, fit_model, block['subject'], str(block['start_idx']),
+                    str(block['end_idx']), block['data_file'], base_dir]
+        fit_log = open(opj(base_dir,'pp_data',block['subject'],fit_model,'log_outputs',
+                    '%s_%s_vox_%i_to_%i.log'%(block['subject'],block['hemi'],block['start_idx'],block['end_idx'])), 'w')
+        fit_proc = subprocess.Popen(fit_cmd, stdout = fit_log, stderr = subprocess.STDOUT)
+
+        # keep lease alive while the block is fitted, stop if it was taken over
+        lease_lost = False
+        while fit_proc.poll() is None:
+            time.sleep(np.min((60, lease_dur/3)))
+            if fit_proc.poll() is None and not renew_lease(block, lease_dur):
+                lease_lost = True
+                fit_proc.terminate()
+                fit_proc.wait()
+        fit_log.close()
+        if lease_lost:
+            print('lease of %s taken over by another worker, fit stopped'%block['output_file'])
+            continue
+
+        done = os.path.isfile(block['output_file']) and os.path.getsize(block['output_file']) != 0
+        state = release_block(block, done, max_attempts = analysis_info['lease_max_attempts'])
+        if state == 'todo': print('fit of %s failed, block released for re-issue'%block['output_file'])
+        elif state == 'failed': print('fit of %s failed %i times, block marked failed'%(block['output_file'], analysis_info['lease_max_attempts']))
+
+elif action == 'submit':
+
+    # Send generic workers to the cluster queue
+    num_workers = int(sys.argv[3])
+    job_dur_req = float(sys.argv[4])
+    if jobscript_template_file is None:
+        sys.exit('no worker jobscript template for %s: submit is only set up for lisa, start workers with the work action'%platform.uname()[1])
+    try: os.makedirs(opj(ledger_dir,'jobs'))
+    except OSError: pass
+
+    jobscript = open(jobscript_template_file)
+    working_string = jobscript.read()
+    jobscript.close()
+
+    re_dict = { '---job_dur---':'%i:00:00'%job_dur_req,
+                '---fit_model---':fit_model,
+                '---lease_dur---':'1'}
+    for e in re_dict.keys():
+        working_string  =   working_string.replace(e, re_dict[e])
+
+    js_name = opj(ledger_dir,'jobs','worker_%s.sh'%fit_model)
+    of = open(js_name, 'w')
+    of.write(working_string)
+    of.close()
+
+    os.chdir(opj(ledger_dir,'jobs'))
+    for worker in np.arange(0,num_workers,1):
+        print('submitting ' + js_name + ' to queue')
+        os.system('qsub ' + js_name)
+
+elif action == 'status':
+
+    # Report ledger state per subject
+    blocks = ledger_blocks(ledger_dir)
+    subjects = sorted(set([block['subject'] for block in blocks]))
+    for subject in subjects:
+        states = [block['state'] for block in blocks if block['subject'] == subject]
+        print('%s: %i/%i done, %i leased, %i expired, %i to do, %i failed'%(subject, states.count('done'), len(states),
+                states.count('leased'), states.count('expired'), states.count('todo'), states.count('failed')))
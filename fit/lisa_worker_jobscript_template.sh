@@ -0,0 +1,6 @@
+#!/bin/bash
+#PBS -lwalltime=---job_dur---
+#PBS -lnodes=1
+
+cd $HOME/projects/retino_HCP/
+python fit/lease_fit_jobs.py work ---fit_model--- ---lease_dur---
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""
+-----------------------------------------------------------------------------------------
+manifest.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Fill and query the dataset manifest (data shapes and fit slice states)
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: action ('scan','report')
+sys.argv[2]: fit model ('gauss','css')
+sys.argv[3:]: scan: subject names (optional, default all subjects of settings.json)
+-----------------------------------------------------------------------------------------
+Output(s):
+pp_data/manifest.sqlite
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python fit/manifest.py scan gauss 999999 192641
+python fit/manifest.py report gauss
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import os
+import re
+import glob
+import json
+import sys
+import platform
+opj = os.path.join
+
+# Functions import
+from fit_utils import open_manifest, manifest_data_shape, manifest_register_chunks, manifest_update_chunk
+from fit_utils import manifest_refresh_chunks
+
+# Get inputs
+action = sys.argv[1]
+fit_model = sys.argv[2]
+
+# Load the analysis parameters from json file
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+# Define server or cluster settings
+if 'lisa' in platform.uname()[1]:
+    base_dir = analysis_info['lisa_cluster_base_folder']
+elif 'aeneas' in platform.uname()[1]:
+    base_dir = analysis_info['aeneas_base_folder']
+elif 'local' in platform.uname()[1]:
+    base_dir = analysis_info['local_base_folder']
+
+manifest = open_manifest(opj(base_dir,'pp_data','manifest.sqlite'))
+
+if action == 'scan':
+
+    # Register data shapes and fit slices found on disk
+    if len(sys.argv) > 3: subjects = sys.argv[3:]
+    else: subjects = analysis_info['subject_list']
+
+    for subject in subjects:
+        for hemi in ['L','R']:
+            data_file = sorted(glob.glob(opj(base_dir,'raw_data',subject,'*RETBAR1_7T*%s.func_bla_psc_av.gii'% hemi)))
+            manifest.execute("DELETE FROM data_files WHERE subject = ? AND hemi = ?", (subject, hemi))
+            ts_num, vox_num = manifest_data_shape(manifest, subject, hemi, data_file[0])
+
+            base_file_name = os.path.split(data_file[0])[-1][:-7]
+            fit_files = sorted(glob.glob(opj(base_dir,'pp_data',subject,fit_model,'fit',base_file_name + '_est_*_to_*.gii')))
+            chunks = []
+            for fit_file in fit_files:
+                # skip files of killed jobs (e.g. _est_0_to_2500_tmp.gii)
+                slice_match = re.search(r'_est_(\d+)_to_(\d+)\.gii$', fit_file)
+                if slice_match is None: continue
+                chunks.append((int(slice_match.group(1)), int(slice_match.group(2)), fit_file))
+            manifest_register_chunks(manifest, subject, hemi, fit_model, chunks)
+            for chunk in chunks:
+                manifest_update_chunk(manifest, chunk[2])
+            print('%s %s: %i time points, %i vertices, %i fit slices'%(subject, hemi, ts_num, vox_num, len(chunks)))
+
+elif action == 'report':
+
+    # Slices written by fit jobs and lease workers since last refresh
+    for (subject,) in manifest.execute("SELECT DISTINCT subject FROM fit_chunks WHERE fit_model = ?", (fit_model,)).fetchall():
+        manifest_refresh_chunks(manifest, subject, fit_model)
+
+    # Cohort-wide progress
+    rows = manifest.execute("""SELECT fit_chunks.subject, COUNT(*), SUM(done), SUM(size),
+                                    SUM(CASE WHEN done THEN end_idx - start_idx ELSE 0 END),
+                                    (SELECT SUM(vox_num) FROM data_files WHERE data_files.subject = fit_chunks.subject)
+                                FROM fit_chunks WHERE fit_model = ? GROUP BY fit_chunks.subject ORDER BY fit_chunks.subject""",
+                            (fit_model,)).fetchall()
+    num_done_sub = 0
+    for subject, num_chunks, num_done, size, vox_done, vox_num in rows:
+        vox_num = vox_num if vox_num else 0
+        if num_done == num_chunks: num_done_sub += 1
+        print('%s: %i/%i slices done, %i/%i vertices, %1.1f MB'%(subject, num_done, num_chunks, vox_done, vox_num, size/1e6))
+    print('%i/%i subjects fully fitted with %s model'%(num_done_sub, len(rows), fit_model))
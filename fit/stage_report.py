@@ -0,0 +1,107 @@
+"""
+-----------------------------------------------------------------------------------------
+stage_report.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Aggregate stage timing logs of fit and post-fit jobs across subjects and hosts
+to find slow stages, slow subjects, slow hosts and regressions
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: fit model ('gauss','css')
+sys.argv[2:]: subject names (optional, default all subjects with a stage timing log)
+-----------------------------------------------------------------------------------------
+Output(s):
+tables of stage timings
+-----------------------------------------------------------------------------------------
+Exemple:
+cd /home/szinte/projects/retino_HCP/
+python fit/stage_report.py gauss
+python fit/stage_report.py gauss 192641 105923
+-----------------------------------------------------------------------------------------
+"""
+
+# General imports
+import os
+import sys
+import glob
+import json
+import platform
+import numpy as np
+opj = os.path.join
+
+# Functions import
+from fit_utils import stage_log_file, read_stage_logs, vertex_time_bins
+
+# Get inputs
+fit_model = sys.argv[1]
+
+# Load the analysis parameters from json file
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+# Define server or cluster settings
+if 'lisa' in platform.uname()[1]:
+    base_dir = analysis_info['lisa_cluster_base_folder']
+elif 'aeneas' in platform.uname()[1]:
+    base_dir = analysis_info['aeneas_base_folder']
+elif 'local' in platform.uname()[1]:
+    base_dir = analysis_info['local_base_folder']
+
+# Read stage timing logs
+if len(sys.argv) > 2: log_files = [stage_log_file(base_dir, subject, fit_model) for subject in sys.argv[2:]]
+else: log_files = sorted(glob.glob(stage_log_file(base_dir, '*', fit_model)))
+records = read_stage_logs([log_file for log_file in log_files if os.path.isfile(log_file)])
+if len(records) == 0:
+    sys.exit('no stage timing found for %s'%fit_model)
+done = [record for record in records if record['status'] == 'done']
+
+def stage_table(records, key):
+    """group records by key: runs, wall and throughput statistics"""
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get(key), []).append(record)
+    rows = []
+    for name in sorted(groups, key = str):
+        wall = np.array([record['wall_s'] for record in groups[name]])
+        rate = np.array([record['vertices_per_s'] for record in groups[name] if record.get('vertices_per_s')])
+        rows.append((name, wall.shape[0], np.sum(wall)/3600.0, np.median(wall), np.percentile(wall, 90),
+                     np.median(rate) if rate.shape[0] > 0 else np.nan,
+                     np.max([record['rss_lifetime_peak_mb'] for record in groups[name]])))
+    return rows
+
+def print_table(title, rows):
+    print('\n%s'%title)
+    print('%-20s %6s %10s %10s %10s %12s %10s'%('','runs','total (h)','med (s)','p90 (s)','vertex/s','peak (MB)'))
+    for row in rows:
+        print('%-20s %6i %10.2f %10.2f %10.2f %12.1f %10.0f'%((str(row[0]),) + row[1:]))
+
+# Stages: where time goes
+print('%i stage records, %i failed, %i hosts, %i subjects'%(len(records), len(records) - len(done),
+    len(set([record['host'] for record in records])), len(set([record['subject'] for record in records]))))
+print_table('per stage', stage_table(done, 'stage'))
+
+# Hosts: fit throughput per host
+optimize = [record for record in done if record['stage'] == 'optimize']
+if len(optimize) > 0:
+    print_table('optimize per host', stage_table(optimize, 'host'))
+
+# Days: fit throughput over time, for regressions
+if len(optimize) > 0:
+    for record in optimize: record['day'] = record['time'][:10]
+    print_table('optimize per day', stage_table(optimize, 'day'))
+
+# Subjects: slowest total wall time
+subject_rows = sorted(stage_table(done, 'subject'), key = lambda row: -row[2])
+print_table('slowest subjects', subject_rows[:10])
+
+# Per-vertex fit times pooled over jobs
+hists = [record['vertex_time_hist'] for record in optimize if 'vertex_time_hist' in record]
+if len(hists) > 0:
+    hist = np.sum(hists, axis = 0)
+    cum_hist = np.cumsum(hist)/np.sum(hist)
+    print('\nper-vertex fit time (%i vertices)'%np.sum(hist))
+    for pct in [0.5, 0.9, 0.99]:
+        print('p%-3i <= %.3f s'%(pct*100, 10**vertex_time_bins[1:][np.argmax(cum_hist >= pct)]))
+    for bin_num in np.where(hist > 0)[0]:
+        print('%8.3f - %8.3f s %10i'%(10**vertex_time_bins[bin_num], 10**vertex_time_bins[bin_num+1], hist[bin_num]))
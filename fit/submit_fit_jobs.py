@@ -9,7 +9,7 @@ Input(s):
 sys.argv[1]: subject name (e.g. 'sub-001')
 sys.argv[2]: subject hemisphere (e.g. 'L')
 sys.argv[3]: fit model ('gauss','css')
-sys.argv[4]: voxel per jobs (used 400 on lisa)
+sys.argv[4]: fittable voxel per jobs (used 400 on lisa)
 sys.argv[5]: job duration requested in hours (used 10h on lisa)
 -----------------------------------------------------------------------------------------
 Output(s):
@@ -33,12 +33,13 @@ import os
 import glob
 import json
 import sys
-import nibabel as nb
 import platform
-import ipdb
-deb = ipdb.set_trace
 opj = os.path.join
 
+# Functions import
+from fit_utils import open_manifest, manifest_data_shape, manifest_register_chunks, manifest_chunks, manifest_refresh_chunks
+from fit_utils import load_ts_columns, triage_vertices, load_triage_mask, balance_chunks
+
 # Get subject number and hemisphere to analyse
 subject = sys.argv[1]
 hemi = sys.argv[2]
@@ -77,34 +78,48 @@ try:
 except:
     pass
 
-data = []
-    
 # Determine data to analyse
 data_file  =  sorted(glob.glob(opj(base_dir,'raw_data',subject,'*RETBAR1_7T*%s.func_bla_psc_av.gii'% hemi)))
 
 # Cut it in small pieces of voxels
-data_file_load = nb.load(data_file[0])
-data.append(np.array([data_file_load.darrays[i].data for i in range(len(data_file_load.darrays))]))
-data = np.vstack(data)
-data_size = data.shape
-
-start_idx =  np.arange(0,data_size[1],job_vox)
-end_idx = start_idx+job_vox
-end_idx[-1] = data_size[1]
+manifest = open_manifest(opj(base_dir,'pp_data','manifest.sqlite'))
+data_size = manifest_data_shape(manifest, subject, hemi, data_file[0])
+
+chunks = manifest_chunks(manifest, subject, fit_model, hemi)
+if len(chunks) > 0:
+    # keep slices already registered for this subject
+    start_idx = np.array([chunk['start_idx'] for chunk in chunks])
+    end_idx = np.array([chunk['end_idx'] for chunk in chunks])
+else:
+    # slices with similar number of fittable vertices
+    if analysis_info['triage_mask']: triage_mask_file = opj(base_dir,'raw_data',analysis_info['triage_mask'].format(hemi = hemi))
+    else: triage_mask_file = None
+    fittable = triage_vertices( data = load_ts_columns(data_file[0])[0],
+                                mask = load_triage_mask(triage_mask_file))
+    start_idx, end_idx = balance_chunks(fittable, job_vox)
+    print('%i/%i vertices to fit'%(fittable.sum(),data_size[1]))
 
 print('%i jobs of %1.1fh each will be run/send to %s'%(start_idx.shape[0],job_dur_req,platform.uname()[1]))
 
-job_input = []
+# Register slices in manifest
+base_file_name = os.path.split(data_file[0])[-1][:-7]
+manifest_register_chunks(manifest, subject, hemi, fit_model,
+    [(start_idx[iter_job], end_idx[iter_job], opj(base_dir,'pp_data',subject,fit_model,'fit',
+        base_file_name + '_est_%s_to_%s.gii' %(str(int(start_idx[iter_job])),str(int(end_idx[iter_job]))))) 
+        for iter_job in np.arange(0,start_idx.shape[0],1)])
+chunks_done = [chunk['output_file'] for chunk in manifest_refresh_chunks(manifest, subject, fit_model, hemi) if chunk['done']]
+
 for iter_job in np.arange(0,start_idx.shape[0],1):
-    job_input = data[:,int(start_idx[iter_job]):int(end_idx[iter_job])]
 
     print('input data vox num: %i to %i'%(int(start_idx[iter_job]),int(end_idx[iter_job])))
 
     # Define output file
-    base_file_name = os.path.split(data_file[0])[-1][:-7]
     opfn = opj(base_dir,'pp_data',subject,fit_model,'fit',base_file_name + '_est_%s_to_%s.gii' %(str(int(start_idx[iter_job])),str(int(end_idx[iter_job]))))
 
-    if os.path.isfile(opfn):
+    if opfn in chunks_done:
+        print('output file %s is done in manifest. aborting analysis of voxels %s to %s'%(opfn,str(int(start_idx[iter_job])),str(int(end_idx[iter_job]))))
+        continue
+    elif os.path.isfile(opfn):
         if os.path.getsize(opfn) != 0:
             print('output file %s already exists and is non-empty. aborting analysis of voxels %s to %s'%(opfn,str(int(start_idx[iter_job])),str(int(end_idx[iter_job]))))
             continue
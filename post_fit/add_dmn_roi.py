@@ -6,12 +6,13 @@ Goal of the script:
 Import to pycortex the Yeo atlas to draw the DMN (default mode network) on flatmap
 -----------------------------------------------------------------------------------------
 Input(s):
-sys.argv[1]: subject number
+None
 -----------------------------------------------------------------------------------------
 Output(s):
 None
 -----------------------------------------------------------------------------------------
 To run:
+cd /home/szinte/projects/retino_HCP
 python post_fit/add_dmn_roi.py
 -----------------------------------------------------------------------------------------
 """
@@ -28,25 +29,24 @@ import sys
 import json
 import glob
 import numpy as np
-import matplotlib.pyplot as pl
-import ipdb
 import platform
 opj = os.path.join
-deb = ipdb.set_trace
 
 # MRI imports
 # -----------
 import nibabel as nb
+import matplotlib
+matplotlib.use('Agg')
 import cortex
 
+# Check system
+# ------------
+sys.exit('Drawing Flatmaps needs Python 3 (headless rendering of post_fit/utils.py). Aborting.') if sys.version_info[0] < 3 else None
+
 # Functions import
 # ----------------
 from utils import set_pycortex_config_file, draw_cortex_vertex
 
-# Check system
-# ------------
-sys.exit('Drawing Flatmaps only works with Python 2. Aborting.') if sys.version_info[0] > 2 else None
-
 # Define analysis parameters
 # --------------------------
 with open('settings.json') as f:
@@ -0,0 +1,96 @@
+"""
+-----------------------------------------------------------------------------------------
+check_resampling.py
+-----------------------------------------------------------------------------------------
+Goal of the script:
+Compare python resampling weights (resample_method 'python') to wb_command
+-metric-resample ADAP_BARY_AREA on the pRF derivatives of a subject, before
+switching resample_method of settings.json away from 'wb_command'
+-----------------------------------------------------------------------------------------
+Input(s):
+sys.argv[1]: subject number
+sys.argv[2]: fit model ('gauss','css')
+-----------------------------------------------------------------------------------------
+Output(s):
+json report of maximal absolute difference, correlation and nan mismatch per
+derivative and mask, in pp_data/resample_cache
+-----------------------------------------------------------------------------------------
+To run:
+cd /home/szinte/projects/retino_HCP
+python post_fit/check_resampling.py 192641 gauss
+-----------------------------------------------------------------------------------------
+"""
+
+# Stop warnings
+# -------------
+import warnings
+warnings.filterwarnings("ignore")
+
+# General imports
+# ---------------
+import os
+import sys
+import json
+import numpy as np
+import platform
+opj = os.path.join
+
+# MRI imports
+# -----------
+import nibabel as nb
+
+# Functions import
+# ----------------
+from utils import resample_weights, wb_metric_resample, validate_resampling
+
+# Get inputs
+# ----------
+subject = sys.argv[1]
+fit_model = sys.argv[2]
+
+# Define analysis parameters
+# --------------------------
+with open('settings.json') as f:
+    json_s = f.read()
+    analysis_info = json.loads(json_s)
+
+# Define cluster/server specific parameters
+# -----------------------------------------
+if 'aeneas' in platform.uname()[1]:
+    base_dir = analysis_info['aeneas_base_folder']
+    main_cmd = '/home/szinte/software/workbench/bin_rh_linux64/wb_command' # put the directory for you wb_command
+elif 'local' in platform.uname()[1]:
+    base_dir = analysis_info['local_base_folder']
+    main_cmd = '/Applications/workbench/bin_macosx64/wb_command' # put the directory for you wb_command
+deriv_dir = opj(base_dir,'pp_data',subject,fit_model,'deriv')
+cache_dir = opj(base_dir,'pp_data','resample_cache')
+
+# Compare resampling methods
+# --------------------------
+report = {'subject': subject, 'fit_model': fit_model, 'wb_command': main_cmd, 'metrics': {}}
+for hemi in ['L','R']:
+    metric_in = opj(deriv_dir,'all',"prf_deriv_{hemi}_all.gii".format(hemi = hemi))
+    vox_num = nb.load(metric_in).darrays[0].data.shape[0]
+    resample_files = (  opj(base_dir,'raw_data/surfaces/resample_fsaverage','fs_LR-deformed_to-fsaverage.{hemi}.sphere.{num_vox_k}k_fs_LR.surf.gii'.format(hemi=hemi, num_vox_k = int(np.round(vox_num/1000)))),
+                        opj(base_dir,'raw_data/surfaces/resample_fsaverage','fsaverage_std_sphere.{hemi}.164k_fsavg_{hemi}.surf.gii'.format(hemi=hemi)),
+                        opj(base_dir,'raw_data/surfaces/resample_fsaverage','fs_LR.{hemi}.midthickness_va_avg.{num_vox_k}k_fs_LR.shape.gii'.format(hemi=hemi,num_vox_k = int(np.round(vox_num/1000)))),
+                        opj(base_dir,'raw_data/surfaces/resample_fsaverage','fsaverage.{hemi}.midthickness_va_avg.164k_fsavg_{hemi}.shape.gii'.format(hemi=hemi)))
+    weights = resample_weights(*resample_files, cache_dir = cache_dir)
+
+    for mask_dir in ['all','pos','neg']:
+        metric_in = opj(deriv_dir,mask_dir,"prf_deriv_{hemi}_{mask_dir}.gii".format(hemi = hemi, mask_dir = mask_dir))
+        metric_wb = opj(cache_dir,"check_{subject}_{fit_model}_{hemi}_{mask_dir}_wb.func.gii".format(subject = subject, fit_model = fit_model, hemi = hemi, mask_dir = mask_dir))
+        data_wb = wb_metric_resample(main_cmd, [darray.data for darray in nb.load(metric_in).darrays], *resample_files)
+        nb.save(nb.gifti.gifti.GiftiImage(darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in data_wb]), metric_wb)
+
+        max_abs_diff, corr, nan_diff = validate_resampling(metric_in, metric_wb, weights)
+        os.remove(metric_wb)
+        report['metrics']['{hemi}_{mask_dir}'.format(hemi = hemi, mask_dir = mask_dir)] = {
+            'max_abs_diff': max_abs_diff.tolist(), 'corr': corr.tolist(), 'nan_diff': nan_diff.tolist()}
+        print('%s %s: max abs diff %.4g, min corr %.6f, %i nan mismatches'%(hemi, mask_dir,
+                np.nanmax(max_abs_diff), np.nanmin(corr), np.sum(nan_diff)))
+
+report_file = opj(cache_dir,'validation_{subject}_{fit_model}.json'.format(subject = subject, fit_model = fit_model))
+with open(report_file, 'w') as f:
+    json.dump(report, f, indent = 2)
+print('report saved in %s'%report_file)
@@ -0,0 +1,514 @@
+import os
+import numpy as np
+
+# derivative rows (see convert_fit_results)
+sign_idx, rsq_idx, ecc_idx, polar_real_idx, polar_imag_idx , size_idx, \
+            non_lin_idx, amp_idx, baseline_idx, cov_idx, x_idx, y_idx = 0,1,2,3,4,5,6,7,8,9,10,11
+
+def read_subject_rois(h5_dir, rois, mask_dir, hemis = ['L','R']):
+    """
+    Read ROI derivatives of one subject from its roi hdf5 files
+
+    Parameters
+    ----------
+    h5_dir: absolute path to subject folder of roi hdf5 files
+    rois: list of roi names
+    mask_dir: derivative mask ('all','pos','neg')
+    hemis: list of hemispheres
+
+    Returns
+    -------
+    data: concatenated derivatives (rows x 12)
+    roi_num: roi number of each row
+    hemi_num: hemisphere number of each row
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import h5py
+
+    data, roi_num, hemi_num = [], [], []
+    for roi_n, roi in enumerate(rois):
+        with h5py.File(os.path.join(h5_dir,'{roi}.h5'.format(roi = roi)), 'r') as h5_file:
+            for hemi_n, hemi in enumerate(hemis):
+                folder_alias = '{hemi}_{mask_dir}'.format(hemi = hemi, mask_dir = mask_dir)
+                in_file = 'prf_deriv_{hemi}_{mask_dir}'.format(hemi = hemi, mask_dir = mask_dir)
+                data_roi = h5_file['{folder_alias}/{in_file}'.format(folder_alias = folder_alias, in_file = in_file)][:,:].T
+                data.append(data_roi)
+                roi_num.append(np.full(data_roi.shape[0], roi_n))
+                hemi_num.append(np.full(data_roi.shape[0], hemi_n))
+
+    return np.vstack(data), np.concatenate(roi_num), np.concatenate(hemi_num)
+
+def subject_pool_map(func, args, n_procs):
+    """
+    Map func over subject arguments in worker processes (h5py reads hold a global
+    lock, so threads do not read subjects in parallel)
+
+    Parameters
+    ----------
+    func: module level function of one subject
+    args: list of argument tuples, one per subject
+    n_procs: number of processes (1 to run in the calling process)
+
+    Returns
+    -------
+    output: list of func outputs, in args order
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import multiprocessing
+
+    if n_procs <= 1 or len(args) <= 1:
+        return [func(*arg) for arg in args]
+
+    with multiprocessing.Pool(processes = min(n_procs, len(args))) as pool:
+        output = pool.starmap(  func = func,
+                                iterable = args,
+                                chunksize = max(1, len(args) // (n_procs * 4)))
+
+    return output
+
+def read_group_rois(h5_dirs, rois, mask_dir, hemis = ['L','R'], n_procs = 8):
+    """
+    Read ROI derivatives of several subjects in parallel processes
+
+    Parameters
+    ----------
+    h5_dirs: list of absolute paths to subject folders of roi hdf5 files
+    rois: list of roi names
+    mask_dir: derivative mask ('all','pos','neg')
+    hemis: list of hemispheres
+    n_procs: number of processes reading subjects
+
+    Returns
+    -------
+    data: concatenated derivatives (rows x 12)
+    subject_num: subject number (position in h5_dirs) of each row
+    roi_num: roi number of each row
+    hemi_num: hemisphere number of each row
+    """
+
+    subject_data = subject_pool_map(func = read_subject_rois,
+                                    args = [(h5_dir, rois, mask_dir, hemis) for h5_dir in h5_dirs],
+                                    n_procs = n_procs)
+
+    subject_num = np.concatenate([np.full(data.shape[0], subject_n) for subject_n, (data, roi_num, hemi_num) in enumerate(subject_data)])
+    data, roi_num, hemi_num = [np.concatenate(values) for values in zip(*subject_data)]
+
+    return data, subject_num, roi_num, hemi_num
+
+def read_group_cohort(cohort_file, subjects, rois, mask_dir, hemis = ['L','R']):
+    """
+    Read ROI derivatives of several subjects from the cohort hdf5 store (see append_cohort_store)
+
+    Parameters
+    ----------
+    cohort_file: absolute path to cohort hdf5 file
+    subjects: list of subject names
+    rois: list of roi names
+    mask_dir: derivative mask ('all','pos','neg')
+    hemis: list of hemispheres
+
+    Returns
+    -------
+    data: concatenated derivatives (rows x 12)
+    subject_num: subject number (position in subjects) of each row
+    roi_num: roi number of each row
+    hemi_num: hemisphere number of each row
+    """
+
+    from utils import read_cohort_store
+
+    data, table = read_cohort_store(cohort_file = cohort_file, subjects = subjects, rois = rois,
+                                    hemis = hemis, mask_dir = mask_dir)
+    subject_num = np.array([subjects.index(subject) for subject in table['subject']], dtype = int)
+    roi_num = np.array([rois.index(roi) for roi in table['roi']], dtype = int)
+    hemi_num = np.array([hemis.index(hemi) for hemi in table['hemi']], dtype = int)
+
+    return data, subject_num, roi_num, hemi_num
+
+def threshold_mask(data, thresholds = None):
+    """
+    Select rows passing thresholds on derivatives
+
+    Parameters
+    ----------
+    data: derivatives (rows x 12)
+    thresholds: dictionary of settings.json thresholds, applied as
+                {rsq,size,cov}_threshold: minimum, r_{size,ecc}_threshold_down: minimum,
+                r_{size,ecc}_threshold_up: maximum (None for no thresholds)
+
+    Returns
+    -------
+    mask: rows with finite r-square passing thresholds
+    """
+
+    mask = ~np.isnan(data[:,rsq_idx])
+    if thresholds is None: return mask
+
+    for key, value in thresholds.items():
+        col = {'rsq': rsq_idx, 'size': size_idx, 'cov': cov_idx, 'ecc': ecc_idx}[key.replace('r_','',1).split('_')[0]]
+        if key.endswith('_up'): mask &= data[:,col] <= value
+        else: mask &= data[:,col] >= value
+
+    return mask
+
+def segment_stats(values, groups, num_groups):
+    """
+    Count, mean and standard deviation (ddof = 1) of values by group
+
+    Parameters
+    ----------
+    values: data values
+    groups: group number of each value
+    num_groups: number of groups
+
+    Returns
+    -------
+    count: number of values per group
+    mean: mean per group (nan for empty group)
+    std: standard deviation per group (nan for group of less than 2 values)
+    """
+
+    count = np.bincount(groups, minlength = num_groups).astype(float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = np.bincount(groups, weights = values, minlength = num_groups) / count
+        std = np.sqrt(np.bincount(groups, weights = (values - mean[groups])**2, minlength = num_groups) / (count - 1))
+    std[count < 2] = np.nan
+
+    return count, mean, std
+
+def roi_summary(data, roi_num, num_rois, thresholds = None):
+    """
+    Compute ROI summaries of one subject as in Figure 2B
+
+    Parameters
+    ----------
+    data: derivatives (rows x 12)
+    roi_num: roi number of each row
+    num_rois: number of rois
+    thresholds: dictionary of thresholds (see threshold_mask)
+
+    Returns
+    -------
+    summary: dictionary of arrays (num_rois) with
+             pprf_rsqr_mean, pprf_rsqr_std, pprf_rsqr_sem: positive pRF r-square
+             nprf_rsqr_mean, nprf_rsqr_std, nprf_rsqr_sem: negative pRF r-square (multiplied by -1)
+             pprf_prop, nprf_prop: proportion of positive and negative (multiplied by -1) pRF
+             vertex: number of vertex passing thresholds
+    """
+
+    mask = threshold_mask(data, thresholds)
+    data, roi_num = data[mask], roi_num[mask]
+    sign, rsq = data[:,sign_idx], data[:,rsq_idx]
+
+    summary = {}
+    vertex = np.bincount(roi_num, minlength = num_rois).astype(float)
+    for prf_type, prf_mask, factor in zip(['pprf','nprf'], [sign > 0.0, sign < 0.0], [1.0, -1.0]):
+        count, mean, std = segment_stats(rsq[prf_mask] * factor, roi_num[prf_mask], num_rois)
+        summary['{}_rsqr_mean'.format(prf_type)] = mean
+        summary['{}_rsqr_std'.format(prf_type)] = std
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            summary['{}_rsqr_sem'.format(prf_type)] = std / np.sqrt(count)
+            summary['{}_prop'.format(prf_type)] = factor * count / vertex
+    summary['vertex'] = vertex
+
+    return summary
+
+def subject_roi_summary(subject, h5_dir, rois, mask_dir = 'all', thresholds = None, cache_dir = None):
+    """
+    Compute ROI summaries of one subject (see roi_summary), cached in cache_dir
+    with a key made of rois, mask, thresholds and roi hdf5 files size and date
+
+    Parameters
+    ----------
+    subject: subject name
+    h5_dir: absolute path to subject folder of roi hdf5 files
+    rois: list of roi names
+    mask_dir: derivative mask ('all','pos','neg')
+    thresholds: dictionary of thresholds (see threshold_mask)
+    cache_dir: folder of cached subject summaries (None for no cache)
+
+    Returns
+    -------
+    summary: dictionary of arrays (rois), see roi_summary
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import hashlib
+    import json
+
+    if cache_dir is not None:
+        key = [rois, mask_dir, thresholds]
+        for roi in rois:
+            h5_file = os.path.join(h5_dir,'{roi}.h5'.format(roi = roi))
+            key.append([os.path.getsize(h5_file), os.path.getmtime(h5_file)])
+        cache_file = os.path.join(cache_dir,'summary_{subject}_{key}.npz'.format(subject = subject,
+                        key = hashlib.sha1(json.dumps(key, sort_keys = True).encode()).hexdigest()))
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cache:
+                return {stat: cache[stat] for stat in cache.files}
+
+    data, roi_num, hemi_num = read_subject_rois(h5_dir, rois, mask_dir)
+    summary = roi_summary(data, roi_num, len(rois), thresholds)
+
+    if cache_dir is not None:
+        try: os.makedirs(cache_dir)
+        except OSError: pass
+        with open(cache_file[:-4] + '_tmp_%i.npz'%os.getpid(), 'wb') as f:
+            np.savez(f, **summary)
+        os.replace(cache_file[:-4] + '_tmp_%i.npz'%os.getpid(), cache_file)
+
+    return summary
+
+def group_roi_summary(subjects, h5_dirs, rois, mask_dir = 'all', thresholds = None, cache_dir = None, n_procs = 8):
+    """
+    Compute ROI summaries of all subjects (see subject_roi_summary), subjects being
+    read in parallel processes. Summaries are cached per subject in cache_dir, so
+    that only new subjects or changed settings are computed again.
+
+    Parameters
+    ----------
+    subjects: list of subject names
+    h5_dirs: list of absolute paths to subject folders of roi hdf5 files
+    rois: list of roi names
+    mask_dir: derivative mask ('all','pos','neg')
+    thresholds: dictionary of thresholds (see threshold_mask)
+    cache_dir: folder of cached subject summaries (None for no cache)
+    n_procs: number of processes computing subject summaries
+
+    Returns
+    -------
+    summary: dictionary of arrays (subjects x rois), see roi_summary
+    """
+
+    subject_summaries = subject_pool_map(   func = subject_roi_summary,
+                                            args = [(subject, h5_dir, rois, mask_dir, thresholds, cache_dir)
+                                                    for subject, h5_dir in zip(subjects, h5_dirs)],
+                                            n_procs = n_procs)
+
+    summary = {stat: np.vstack([subject_sum[stat] for subject_sum in subject_summaries]) for stat in subject_summaries[0].keys()}
+
+    return summary
+
+def cohort_average(summary, subject_idx = None):
+    """
+    Average subject summaries across subjects
+
+    Parameters
+    ----------
+    summary: dictionary of arrays (subjects x rois)
+    subject_idx: subjects to average (e.g. HCP subjects, None for all)
+
+    Returns
+    -------
+    mean: dictionary of arrays (rois) of nan-mean across subjects
+    std: dictionary of arrays (rois) of nan-standard deviation (ddof = 1) across subjects
+    """
+
+    if subject_idx is None: subject_idx = np.arange(list(summary.values())[0].shape[0])
+
+    mean, std = {}, {}
+    for stat, values in summary.items():
+        mean[stat] = np.nanmean(values[subject_idx], axis = 0)
+        std[stat] = np.nanstd(values[subject_idx], axis = 0, ddof = 1)
+
+    return mean, std
+
+def ecc_size_stats(data, subject_num, roi_num, hemi_num, num_subjects, num_rois, thresholds = None):
+    """
+    Compute r-square weighted eccentricity/size regression, correlation and
+    contra-laterality index of every subject, roi and pRF sign as in Figure 3,
+    by reductions over groups of the concatenated vertex arrays
+
+    Parameters
+    ----------
+    data: concatenated derivatives (rows x 12), see read_group_rois
+    subject_num: subject number of each row
+    roi_num: roi number of each row
+    hemi_num: hemisphere number of each row (0: left, 1: right)
+    num_subjects: number of subjects
+    num_rois: number of rois
+    thresholds: dictionary of thresholds (see threshold_mask)
+
+    Returns
+    -------
+    stats: dictionary of arrays (subjects x rois) with
+           {pprf,nprf}_ecc_size_r: weighted correlation of eccentricity and size
+           {pprf,nprf}_ecc_size_slope, {pprf,nprf}_ecc_size_intercept: weighted linear regression of size by eccentricity
+           {pprf,nprf}_contra_lat_idx: contra-laterality index (-1 to 1)
+           {pprf,nprf}_vertex: number of vertex passing thresholds
+    """
+
+    mask = threshold_mask(data, thresholds)
+    data, subject_num, roi_num, hemi_num = data[mask], subject_num[mask], roi_num[mask], hemi_num[mask]
+
+    # groups of subject, roi and pRF sign (0: positive, 1: negative)
+    num_groups = num_subjects * num_rois * 2
+    groups = (subject_num * num_rois + roi_num) * 2 + (data[:,sign_idx] < 0.0)
+    ecc, size, weight = data[:,ecc_idx].astype(float), data[:,size_idx].astype(float), data[:,rsq_idx].astype(float)
+
+    # weighted moments
+    vertex = np.bincount(groups, minlength = num_groups).astype(float)
+    weight_sum = np.bincount(groups, weights = weight, minlength = num_groups)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        ecc_mean = np.bincount(groups, weights = weight * ecc, minlength = num_groups) / weight_sum
+        size_mean = np.bincount(groups, weights = weight * size, minlength = num_groups) / weight_sum
+        ecc_dev, size_dev = ecc - ecc_mean[groups], size - size_mean[groups]
+        cov_ecc_ecc = np.bincount(groups, weights = weight * ecc_dev * ecc_dev, minlength = num_groups) / weight_sum
+        cov_size_size = np.bincount(groups, weights = weight * size_dev * size_dev, minlength = num_groups) / weight_sum
+        cov_ecc_size = np.bincount(groups, weights = weight * ecc_dev * size_dev, minlength = num_groups) / weight_sum
+
+        ecc_size_r = cov_ecc_size / np.sqrt(cov_ecc_ecc * cov_size_size)
+        ecc_size_slope = cov_ecc_size / cov_ecc_ecc
+        ecc_size_intercept = size_mean - ecc_size_slope * ecc_mean
+    for stat in [ecc_size_r, ecc_size_slope, ecc_size_intercept]:
+        stat[vertex < 2] = np.nan
+
+    # contra-laterality index
+    contra_lat = []
+    for hemi_n, contra_side in zip([0,1], [data[:,x_idx] < 0, data[:,x_idx] > 0]):
+        hemi_mask = hemi_num == hemi_n
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            contra_lat.append(np.bincount(groups[hemi_mask], weights = contra_side[hemi_mask], minlength = num_groups) / \
+                              np.bincount(groups[hemi_mask], minlength = num_groups))
+    with np.errstate(invalid = 'ignore'):
+        contra_lat_idx = np.nanmean(np.vstack(contra_lat), axis = 0) * 2.0 - 1.0
+
+    stats = {}
+    for stat_name, stat in zip(['ecc_size_r','ecc_size_slope','ecc_size_intercept','contra_lat_idx','vertex'],
+                               [ecc_size_r, ecc_size_slope, ecc_size_intercept, contra_lat_idx, vertex]):
+        stat = stat.reshape((num_subjects, num_rois, 2))
+        stats['pprf_{}'.format(stat_name)] = stat[...,0]
+        stats['nprf_{}'.format(stat_name)] = stat[...,1]
+
+    return stats
+
+def bootstrap_stats(data, num_boot = 10000, block_size = 1000, seed = None):
+    """
+    Bootstrap the across-subject mean of summary matrices, all resampling indices
+    of a block being drawn and evaluated at once
+
+    Parameters
+    ----------
+    data: summary matrix (subjects x measures, e.g. subjects x rois), nan ignored
+    num_boot: number of bootstrap samples
+    block_size: number of bootstrap samples evaluated at once (bounds memory to block_size x subjects x measures)
+    seed: random generator seed
+
+    Returns
+    -------
+    boot_mat: bootstrapped means (num_boot x measures)
+    """
+
+    rng = np.random.default_rng(seed)
+    num_subjects = data.shape[0]
+    boot_mat = np.zeros((num_boot, data.shape[1]))
+    for block_start in np.arange(0, num_boot, block_size):
+        block_end = np.min((block_start + block_size, num_boot))
+        boot_idx = rng.integers(0, num_subjects, size = (block_end - block_start, num_subjects))
+        with np.errstate(invalid = 'ignore'):
+            boot_mat[block_start:block_end] = np.nanmean(data[boot_idx], axis = 1)
+
+    return boot_mat
+
+def bootstrap_ci(boot_mat, alpha = 0.05):
+    """
+    Percentile confidence intervals of bootstrapped statistics
+
+    Parameters
+    ----------
+    boot_mat: bootstrapped statistics (num_boot x measures)
+    alpha: error rate (0.05 for 95% confidence intervals)
+
+    Returns
+    -------
+    ci: lower and upper bounds (2 x measures)
+    """
+
+    return np.nanpercentile(boot_mat, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis = 0)
+
+def bootstrap_compare(mean_res, boot_mat, comp_vals, bilateral = True):
+    """
+    Bootstrap p-values of differences between pairs of measures, as comp_bootstrap
+    of the figure notebooks for many pairs at once
+
+    Parameters
+    ----------
+    mean_res: measures mean across subjects
+    boot_mat: bootstrapped means (num_boot x measures)
+    comp_vals: pairs of measure numbers to compare (pairs x 2)
+    bilateral: two-sided test
+
+    Returns
+    -------
+    p_vals: p-value of each pair
+    """
+
+    comp_vals = np.atleast_2d(comp_vals)
+    num_boot = boot_mat.shape[0]
+
+    diff_bt = boot_mat[:,comp_vals[:,0]] - boot_mat[:,comp_vals[:,1]]
+    diff_mean = mean_res[comp_vals[:,0]] - mean_res[comp_vals[:,1]]
+    prop_pos = np.sum(diff_bt > 0, axis = 0) / num_boot
+    p_vals = np.where(diff_mean < 0, prop_pos, np.where(diff_mean > 0, 1 - prop_pos, 1.0))
+
+    if bilateral: p_vals = p_vals * 2
+    p_vals[p_vals == 0] = 1 / num_boot
+    p_vals[p_vals > 1] = 1
+
+    return p_vals
+
+def permutation_test(data_a, data_b, num_perm = 10000, paired = True, block_size = 1000, seed = None):
+    """
+    Permutation test of the difference of across-subject means of two summary
+    matrices (e.g. positive vs. negative pRF proportion per roi), all permutations
+    of a block being drawn and evaluated at once
+
+    Parameters
+    ----------
+    data_a: summary matrix (subjects x measures)
+    data_b: summary matrix (subjects x measures), same subjects if paired
+    num_perm: number of permutations
+    paired: sign-flip permutations of the subject differences if True,
+            permutations of the subject labels between the two matrices if False
+    block_size: number of permutations evaluated at once
+    seed: random generator seed
+
+    Returns
+    -------
+    diff_mean: observed difference of means (measures)
+    p_vals: two-sided p-values (measures)
+    """
+
+    rng = np.random.default_rng(seed)
+    if paired:
+        data_diff = data_a - data_b
+        diff_mean = np.nanmean(data_diff, axis = 0)
+    else:
+        data_ab = np.vstack((data_a, data_b))
+        num_a = data_a.shape[0]
+        diff_mean = np.nanmean(data_a, axis = 0) - np.nanmean(data_b, axis = 0)
+
+    num_extreme = np.zeros(diff_mean.shape[0])
+    for block_start in np.arange(0, num_perm, block_size):
+        block_num = np.min((block_size, num_perm - block_start))
+        with np.errstate(invalid = 'ignore'):
+            if paired:
+                signs = rng.choice([-1.0, 1.0], size = (block_num, data_diff.shape[0]))
+                perm_diff = np.nanmean(signs[:,:,np.newaxis] * data_diff[np.newaxis], axis = 1)
+            else:
+                perm_idx = np.argsort(rng.random((block_num, data_ab.shape[0])), axis = 1)
+                data_perm = data_ab[perm_idx]
+                perm_diff = np.nanmean(data_perm[:,:num_a], axis = 1) - np.nanmean(data_perm[:,num_a:], axis = 1)
+        num_extreme += np.sum(np.abs(perm_diff) >= np.abs(diff_mean), axis = 0)
+
+    p_vals = (num_extreme + 1) / (num_perm + 1)
+
+    return diff_mean, p_vals
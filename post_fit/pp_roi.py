@@ -33,20 +33,20 @@ import sys
 import json
 import glob
 import numpy as np
-import matplotlib.pyplot as pl
-import ipdb
 import platform
 opj = os.path.join
-deb = ipdb.set_trace
 
 # MRI imports
 # -----------
 import nibabel as nb
-import cortex
 
 # Functions import
 # ----------------
-from utils import set_pycortex_config_file, convert_fit_results
+from utils import merge_fit_chunks, compute_prf_derivatives, save_prf_derivatives
+from utils import resample_surface_data
+sys.path.append(opj(os.getcwd(),'fit'))
+from fit_utils import ledger_blocks, open_manifest, manifest_data_shape, manifest_refresh_chunks
+from fit_utils import stage_log_file, log_stage
 
 # Check system
 # ------------
@@ -78,14 +78,12 @@ elif 'local' in platform.uname()[1]:
     base_dir = analysis_info['local_base_folder'] 
     main_cmd = '/Applications/workbench/bin_macosx64/wb_command' # put the directory for you wb_command
 deriv_dir = opj(base_dir,'pp_data',subject,fit_model,'deriv')
+log_file = stage_log_file(base_dir, subject, fit_model)
 
 # determine number of vertex and time_serie
-data = []
+manifest = open_manifest(opj(base_dir,'pp_data','manifest.sqlite'))
 data_file  =  sorted(glob.glob(opj(base_dir,'raw_data',subject,'*RETBAR1_7T*.func_bla_psc_av.gii')))
-data_file_load = nb.load(data_file[0])
-data.append(np.array([data_file_load.darrays[i].data for i in range(len(data_file_load.darrays))]))
-data = np.vstack(data) 
-ts_num,vox_num = data.shape[0],data.shape[1]
+ts_num,vox_num = manifest_data_shape(manifest, subject, 'L', data_file[0])
 
 # Check if all slices are present
 # -------------------------------
@@ -95,7 +93,28 @@ end_idx[-1] = vox_num
 num_miss_part = 0
 fit_est_files_L = []
 fit_est_files_R = []
+ledger_dir = opj(base_dir,'pp_data','ledger',fit_model)
 for hemi in ['L','R']:
+    chunks = manifest_refresh_chunks(manifest, subject, fit_model, hemi)
+    if len(chunks) > 0:
+        # slices registered in manifest
+        for chunk in chunks:
+            if chunk['done']:
+                exec('fit_est_files_{hemi}.append(chunk["output_file"])'.format(hemi = hemi))
+            else:
+                num_miss_part += 1
+        continue
+
+    blocks = ledger_blocks(ledger_dir, subject = subject, hemi = hemi)
+    if len(blocks) > 0:
+        # slices fitted by lease workers
+        for block in blocks:
+            if block['state'] == 'done':
+                exec('fit_est_files_{hemi}.append(block["output_file"])'.format(hemi = hemi))
+            else:
+                num_miss_part += 1
+        continue
+
     for iter_job in np.arange(0,start_idx.shape[0],1):
         fit_est_file = opj(base_dir,'pp_data',subject,fit_model,'fit', '%s_%s.func_bla_psc_est_%s_to_%s.gii' %(base_file_name,hemi,str(int(start_idx[iter_job])),str(int(end_idx[iter_job]))))
         if os.path.isfile(fit_est_file):
@@ -106,60 +125,62 @@ for hemi in ['L','R']:
         else:
             num_miss_part += 1
 
-if num_miss_part != 0:
-    sys.exit('%i missing files, analysis stopped'%num_miss_part)
-
-
 # Combine fit files
 # -----------------
 print('combining fit files')
+fit_est, fit_est_hdr = {}, {}
+num_gaps = 0
 for hemi in ['L','R']:
-    data_hemi = np.zeros((fit_val,vox_num))
-    exec('fit_est_files_hemi = fit_est_files_{hemi}'.format(hemi=hemi))    
-    for fit_filename_hemi in fit_est_files_hemi:
-        data_fit_hemi = []
-        data_fit_file_hemi = nb.load(fit_filename_hemi)
-        data_fit_hemi.append(np.array([data_fit_file_hemi.darrays[i].data for i in range(len(data_fit_file_hemi.darrays))]))
-        data_fit_hemi = np.vstack(data_fit_hemi)
-        data_hemi = data_hemi + data_fit_hemi
-
-    darrays_est_hemi = [nb.gifti.gifti.GiftiDataArray(d) for d in data_hemi]
-    exec('gii_out_{hemi} = nb.gifti.gifti.GiftiImage(header = data_fit_file_hemi.header, extra = data_fit_file_hemi.extra,darrays = darrays_est_hemi)'.format(hemi=hemi))
-    exec('nb.save(gii_out_{hemi}, opj(base_dir,"pp_data",subject,fit_model,"fit","{bfn}_{hemi}.func_bla_psc_est.gii"))'.format(hemi=hemi,bfn =base_file_name))
+    exec('fit_est_files_hemi = fit_est_files_{hemi}'.format(hemi=hemi))
+    with log_stage(log_file, 'merge', subject = subject, hemi = hemi, fit_model = fit_model) as stage:
+        fit_est[hemi], fit_est_hdr[hemi], gaps = merge_fit_chunks(  chunk_files = fit_est_files_hemi,
+                                                                    output_file = opj(base_dir,'pp_data',subject,fit_model,'fit','{bfn}_{hemi}.func_bla_psc_est.gii'.format(hemi=hemi,bfn =base_file_name)),
+                                                                    vox_num = vox_num,
+                                                                    fit_val = fit_val)
+        stage['vertices'] = vox_num
+    num_gaps += len(gaps)
+
+if num_miss_part != 0 or num_gaps != 0:
+    sys.exit('%i missing files, %i vertex gaps, analysis stopped (merged slices kept in estimate files)'%(num_miss_part,num_gaps))
 
 # Compute derived measures from prfs
 # ----------------------------------
 print('extracting pRF derivatives')
+prf_deriv = {}
 for hemi in ['L','R']:
-    prf_filename = sorted(glob.glob(opj(base_dir,'pp_data',subject,fit_model,'fit','%s_%s.func_bla_psc_est.gii'%(base_file_name, hemi))))
-    convert_fit_results(prf_filename = prf_filename,
-                        output_dir = deriv_dir,
-                        stim_radius = analysis_info['stim_radius'],
-                        hemi = hemi,
-                        fit_model = fit_model)
+    with log_stage(log_file, 'derivatives', subject = subject, hemi = hemi, fit_model = fit_model) as stage:
+        prf_deriv[hemi] = compute_prf_derivatives(  prf_data = fit_est[hemi],
+                                                    fit_model = fit_model,
+                                                    stim_radius = analysis_info['stim_radius'],
+                                                    memory_budget = analysis_info['cov_memory_budget'],
+                                                    cov_method = analysis_info['cov_method'])
+        save_prf_derivatives(   prf_deriv = prf_deriv[hemi],
+                                output_dir = deriv_dir,
+                                hemi = hemi,
+                                header = fit_est_hdr[hemi])
+        stage['vertices'] = vox_num
 
 
 # Resample gii to fsaverage
 # -------------------------
 print('converting derivative files to fsaverage')
-resample_cmd = """{main_cmd} -metric-resample {metric_in} {current_sphere} {new_sphere} ADAP_BARY_AREA {metric_out} -area-metrics {current_area} {new_area}"""
 for hemi in ['L','R']:
 
-    current_sphere = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fs_LR-deformed_to-fsaverage.{hemi}.sphere.{num_vox_k}k_fs_LR.surf.gii'.format(hemi=hemi, num_vox_k = int(np.round(vox_num/1000))))
-    new_sphere = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fsaverage_std_sphere.{hemi}.164k_fsavg_{hemi}.surf.gii'.format(hemi=hemi))
-    current_area = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fs_LR.{hemi}.midthickness_va_avg.{num_vox_k}k_fs_LR.shape.gii'.format(hemi=hemi,num_vox_k = int(np.round(vox_num/1000))))
-    new_area = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fsaverage.{hemi}.midthickness_va_avg.164k_fsavg_{hemi}.shape.gii'.format(hemi=hemi))
-
-    for mask_dir in ['all','pos','neg']:
-        
-        metric_in = opj(deriv_dir,mask_dir,"prf_deriv_{hemi}_{mask_dir}.gii".format(hemi = hemi, mask_dir = mask_dir))
-        metric_out = opj(deriv_dir,mask_dir,"prf_deriv_{hemi}_{mask_dir}_fsaverage.func.gii".format(hemi = hemi, mask_dir = mask_dir))
-
-        os.system(resample_cmd.format(  main_cmd = main_cmd,
-                                        metric_in = metric_in, 
-                                        current_sphere = current_sphere, 
-                                        new_sphere = new_sphere, 
-                                        metric_out = metric_out, 
-                                        current_area = current_area, 
-                                        new_area = new_area))
-
+    with log_stage(log_file, 'resample', subject = subject, hemi = hemi, fit_model = fit_model) as stage:
+        current_sphere = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fs_LR-deformed_to-fsaverage.{hemi}.sphere.{num_vox_k}k_fs_LR.surf.gii'.format(hemi=hemi, num_vox_k = int(np.round(vox_num/1000))))
+        new_sphere = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fsaverage_std_sphere.{hemi}.164k_fsavg_{hemi}.surf.gii'.format(hemi=hemi))
+        current_area = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fs_LR.{hemi}.midthickness_va_avg.{num_vox_k}k_fs_LR.shape.gii'.format(hemi=hemi,num_vox_k = int(np.round(vox_num/1000))))
+        new_area = opj(base_dir,'raw_data/surfaces/resample_fsaverage','fsaverage.{hemi}.midthickness_va_avg.164k_fsavg_{hemi}.shape.gii'.format(hemi=hemi))
+
+        # all masks resampled at once
+        prf_deriv_fsaverage = resample_surface_data(data = np.vstack([prf_deriv[hemi][mask_dir] for mask_dir in ['all','pos','neg']]),
+                                                    resample_files = (current_sphere, new_sphere, current_area, new_area),
+                                                    method = analysis_info['resample_method'],
+                                                    wb_cmd = main_cmd,
+                                                    cache_dir = opj(base_dir,'pp_data','resample_cache'))
+
+        for mask_num, mask_dir in enumerate(['all','pos','neg']):
+            metric_out = opj(deriv_dir,mask_dir,"prf_deriv_{hemi}_{mask_dir}_fsaverage.func.gii".format(hemi = hemi, mask_dir = mask_dir))
+            darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in np.split(prf_deriv_fsaverage, 3)[mask_num]]
+            nb.save(nb.gifti.gifti.GiftiImage(header = fit_est_hdr[hemi], darrays = darrays), metric_out)
+        stage['vertices'] = vox_num
@@ -1,71 +1,243 @@
 import os
+import contextlib
 import nibabel as nb
 import numpy as np
-import matplotlib.pyplot as pl
-import scipy as sp
-from scipy.signal import savgol_filter
-from skimage.transform import rotate
-from math import *
-import cortex
+
+def tmp_file(file_name):
+    """
+    Define a process-unique temporary name of file_name, to be moved to
+    file_name with os.replace once written
+    """
+
+    root, ext = os.path.splitext(file_name)
+
+    return '{}_tmp.{}.{}{}'.format(root, os.uname()[1], os.getpid(), ext)
 
 def set_pycortex_config_file(project_folder):
+    """
+    Point pycortex of the running process to the project database and colormaps
+    folders, by changing its in-memory configuration (the user config file is not
+    rewritten, so that concurrent processes can use different settings safely)
+
+    Parameters
+    ----------
+    project_folder: absolute path to project pycortex folder (with db and colormaps subfolders)
+
+    Returns
+    -------
+    None
+    """
 
-    
     # Import necessary modules
-    import os
     import cortex
-    from pathlib import Path
-
-    import ipdb
 
     # Define the new database and colormaps folder
     pycortex_db_folder = project_folder + '/db/'
     pycortex_cm_folder = project_folder + '/colormaps/'
 
-    # Get pycortex config file location
-    pycortex_config_file  = cortex.options.usercfg
+    # Change in-memory configuration
+    cortex.options.config.set('basic', 'filestore', pycortex_db_folder)
+    cortex.options.config.set('webgl', 'colormaps', pycortex_cm_folder)
 
-    # Create name of new config file that will be written
-    new_pycortex_config_file = pycortex_config_file[:-4] + '_new.cfg'
+    # Point the already created database to the new folder and clear its caches
+    cortex.db.filestore = pycortex_db_folder
+    cortex.db.reload_subjects()
 
-    # Create the new config file
-    Path(new_pycortex_config_file).touch()
+    return None
 
-    # Open the config file in read mode and the newly created one in write mode.
-    # Loop over every line in the original file and copy it into the new one.
-    # For the lines containing either 'filestore' or 'colormap', it will
-    # change the saved folder path to the newly created one above (e.g. pycortex_db_folder)
-    with open(pycortex_config_file, 'r') as fileIn:
-        with open(new_pycortex_config_file, 'w') as fileOut:
+def compute_prf_coverage(prf_x, prf_y, prf_size, prf_non_lin, stim_radius, memory_budget = 512, method = 'grid'):
+    """
+    Compute ratio of pRF content falling within the stimulus aperture,
+    by blocks of vertices of bounded memory size
 
-            for line in fileIn:
+    Parameters
+    ----------
+    prf_x: pRF x position in deg
+    prf_y: pRF y position in deg
+    prf_size: pRF size in deg
+    prf_non_lin: pRF non-linearity (None for gaussian model)
+    stim_radius: stimulus radius in deg
+    memory_budget: memory used for the receptive field grids in MB
+    method: 'grid' to sum pRFs sampled on the 121x121 grid of -30 to 30 deg,
+            'analytic' to use the gaussian mass within the stimulus disk (gaussian model only)
 
-                if 'filestore' in line:
-                    newline = 'filestore=' + pycortex_db_folder
-                    fileOut.write(newline)
-                    newline = '\n'
+    Returns
+    -------
+    prf_cov: pRF coverage
+    """
 
-                elif 'Colormaps' in line:
-                    newline = 'Colormaps=' + pycortex_cm_folder
-                    fileOut.write(newline)
-                    newline = '\n'
+    if method == 'analytic' and prf_non_lin is None:
+        from scipy.stats import ncx2, norm
 
-                else:
-                    newline = line
+        # gaussian mass within stimulus disk relative to mass within the grid square
+        prf_ecc = np.sqrt(prf_x**2 + prf_y**2)
+        disk_content = ncx2.cdf((stim_radius/prf_size)**2, 2, (prf_ecc/prf_size)**2)
+        total_prf_content = (norm.cdf((30 - prf_x)/prf_size) - norm.cdf((-30 - prf_x)/prf_size)) * \
+                            (norm.cdf((30 - prf_y)/prf_size) - norm.cdf((-30 - prf_y)/prf_size))
+        prf_cov = disk_content / total_prf_content
 
-                fileOut.write(newline)
+        return prf_cov
+
+    from popeye.spinach import generate_og_receptive_fields
+
+    deg_x, deg_y = np.meshgrid(np.linspace(-30, 30, 121), np.linspace(-30, 30, 121))         # define prfs in visual space
+    stim_vignet = np.sqrt(deg_x ** 2 + deg_y**2) < stim_radius
+    block_vox = int(np.max((1, memory_budget * 1e6 // (deg_x.size * 8))))
+
+    prf_cov = np.zeros(prf_x.shape[0])
+    for block_start in np.arange(0, prf_x.shape[0], block_vox):
+        block_end = np.min((block_start + block_vox, prf_x.shape[0]))
+        rfs = generate_og_receptive_fields( np.ascontiguousarray(prf_x[block_start:block_end], dtype = np.float64),
+                                            np.ascontiguousarray(prf_y[block_start:block_end], dtype = np.float64),
+                                            np.ascontiguousarray(prf_size[block_start:block_end], dtype = np.float64),
+                                            np.ones(block_end - block_start),
+                                            deg_x,
+                                            deg_y)
+        if prf_non_lin is not None:
+            rfs **= prf_non_lin[block_start:block_end]
+
+        total_prf_content = rfs.reshape((-1, block_end - block_start)).sum(axis=0)
+        prf_cov[block_start:block_end] = rfs[stim_vignet, :].sum(axis=0) / total_prf_content
+
+    return prf_cov
+
+def compute_prf_derivatives(prf_data,
+                            fit_model,
+                            stim_radius,
+                            memory_budget = 512,
+                            cov_method = 'grid'):
+    """
+    Compute pRF derivatives once and derive all/positive/negative pRF versions by masking
+
+    Parameters
+    ----------
+    prf_data: pRF fit estimates (estimates x vertices)
+    fit_model: fit model ('gauss','css')
+    stim_radius: stimulus radius in deg
+    memory_budget: memory used for pRF coverage computation in MB
+    cov_method: pRF coverage computation ('grid' or 'analytic' for gaussian model)
+
+    Returns
+    -------
+    prf_deriv: dictionary with 'all', 'pos' and 'neg' float32 derivative matrices (12 x vertices),
+    rows as in convert_fit_results, vertices out of the mask set to nan
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import numpy as np
+
+    # get data index
+    if fit_model == 'gauss':
+        x_idx, y_idx, sigma_idx, beta_idx, baseline_idx, rsq_idx = 0, 1, 2, 3, 4, 5
+    elif fit_model == 'css':
+        x_idx, y_idx, sigma_idx, non_lin_idx, beta_idx, baseline_idx, rsq_idx = 0, 1, 2, 3, 4, 5, 6
+
+    prf_x, prf_y = prf_data[x_idx,:], prf_data[y_idx,:]
+    deriv_all = np.empty((12,prf_data.shape[1]), dtype = np.float32)
+
+    # pRF sign
+    deriv_all[0] = np.sign(prf_data[beta_idx,:])
+
+    # r-square
+    deriv_all[1] = prf_data[rsq_idx,:]
+
+    # pRF eccentricity
+    prf_ecc = np.sqrt(prf_x**2 + prf_y**2)
+    deriv_all[2] = np.nan_to_num(prf_ecc)
+
+    # pRF polar angle
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        deriv_all[3] = prf_x / prf_ecc
+        deriv_all[4] = prf_y / prf_ecc
+
+    # pRF size
+    prf_size = prf_data[sigma_idx,:].astype(np.float64)
+    prf_size[prf_size<1e-4] = 1e-4
+    deriv_all[5] = prf_size
+
+    # pRF non-linearity
+    if fit_model == 'gauss': deriv_all[6] = np.nan
+    elif fit_model == 'css': deriv_all[6] = prf_data[non_lin_idx,:]
+
+    # pRF amplitude
+    deriv_all[7] = prf_data[beta_idx,:]
+
+    # pRF baseline
+    deriv_all[8] = prf_data[baseline_idx,:]
+
+    # pRF coverage
+    deriv_all[9] = compute_prf_coverage(prf_x = prf_x,
+                                        prf_y = prf_y,
+                                        prf_size = prf_size,
+                                        prf_non_lin = prf_data[non_lin_idx,:] if fit_model == 'css' else None,
+                                        stim_radius = stim_radius,
+                                        memory_budget = memory_budget,
+                                        method = cov_method)
+
+    # pRF x
+    deriv_all[10] = prf_x
+
+    # pRF y
+    deriv_all[11] = prf_y
+
+    # Masks
+    # -----
+    pos_mask = deriv_all[0] > 0.0
+    neg_mask = deriv_all[0] < 0.0
+    all_mask = pos_mask | neg_mask
+
+    prf_deriv = {}
+    for mask_dir, mask in zip(['all','pos','neg'],[all_mask,pos_mask,neg_mask]):
+        prf_deriv[mask_dir] = np.full(deriv_all.shape, np.nan, dtype = np.float32)
+        prf_deriv[mask_dir][:,mask] = deriv_all[:,mask]
+
+    return prf_deriv
+
+def save_prf_derivatives(prf_deriv, output_dir, hemi, header = None, extra = None):
+    """
+    Save pRF derivatives matrices in gifti files
+
+    Parameters
+    ----------
+    prf_deriv: dictionary of derivative matrices by mask (output of compute_prf_derivatives)
+    output_dir: absolute path to directory into which to put the resulting files.
+    hemi: brain hemisphere
+    header: gifti header
+    extra: gifti extra
+
+    Returns
+    -------
+    None
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import os
+    import nibabel as nb
+
+    for mask_dir in prf_deriv.keys():
+        try: os.makedirs(os.path.join(output_dir,mask_dir))
+        except OSError: pass
+
+        deriv_file = os.path.join(output_dir,mask_dir,"prf_deriv_{hemi}_{mask_dir}.gii".format(hemi = hemi, mask_dir = mask_dir))
+        print('saving: %s'%deriv_file)
+        darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in prf_deriv[mask_dir]]
+        gii_out = nb.gifti.gifti.GiftiImage(header = header, extra = extra, darrays = darrays)
+        nb.save(gii_out, deriv_file)
 
-    
-    # Renames the original config file als '_old' and the newly created one to the original name
-    os.rename(pycortex_config_file, pycortex_config_file[:-4] + '_old.cfg')
-    os.rename(new_pycortex_config_file, pycortex_config_file)
     return None
 
 def convert_fit_results(prf_filename,
                         output_dir,
                         stim_radius,
                         hemi,
-                        fit_model):
+                        fit_model,
+                        memory_budget = 512,
+                        cov_method = 'grid',
+                        save_gii = True):
     """
     Convert pRF fitting value in different parameters for following analysis
    
@@ -76,12 +248,17 @@ def convert_fit_results(prf_filename,
     stim_radius: stimulus radius in deg
     hemi: brain hemisphere
     fit_model: fit model ('gauss','css')
+    memory_budget: memory used for pRF coverage computation in MB
+    cov_method: pRF coverage computation ('grid' or 'analytic' for gaussian model)
+    save_gii: save derivatives as gifti files in output_dir
 
     Returns
     -------
-    prf_deriv_L_all and  prf_deriv_R_all: derivative of pRF analysis for all pRF voxels
-    prf_deriv_L_neg and  prf_deriv_R_neg : derivative of pRF analysis for all negative pRF voxels
-    prf_deriv_L_pos and  prf_deriv_R_pos : derivative of pRF analysis for all positive pRF voxels
+    prf_deriv: dictionary with derivative matrices by mask
+    prf_deriv['all']: derivative of pRF analysis for all pRF voxels
+    prf_deriv['neg']: derivative of pRF analysis for all negative pRF voxels
+    prf_deriv['pos']: derivative of pRF analysis for all positive pRF voxels
+    (saved as prf_deriv_L_all, prf_deriv_R_all, ... if save_gii)
 
     stucture output:
     columns: 1->32492
@@ -105,124 +282,868 @@ def convert_fit_results(prf_filename,
     # Imports
     # -------
     # General imports
-    import os
     import nibabel as nb
-    import glob
     import numpy as np
-    import ipdb
-    deb = ipdb.set_trace
-
-    # Popeye imports
-    from popeye.spinach import generate_og_receptive_fields
-
-
-    # Create folders
-    # --------------
-    try:
-        os.makedirs(os.path.join(output_dir,'all'))
-        os.makedirs(os.path.join(output_dir,'pos'))
-        os.makedirs(os.path.join(output_dir,'neg'))
-    except:
-        pass
 
     # Get data details
     # ----------------
-    prf_data = []
     prf_data_load = nb.load(prf_filename[0])
-    prf_data.append(np.array([prf_data_load.darrays[i].data for i in range(len(prf_data_load.darrays))]))
-    prf_data = np.vstack(prf_data)    
-    ext = prf_data_load.extra
-    hdr = prf_data_load.header
+    prf_data = np.vstack([darray.data for darray in prf_data_load.darrays])
 
     # Compute derived measures from prfs
     # ----------------------------------
-    # get data index
-    if fit_model == 'gauss':
-        x_idx, y_idx, sigma_idx, beta_idx, baseline_idx, rsq_idx = 0, 1, 2, 3, 4, 5
-    elif fit_model == 'css':
-        x_idx, y_idx, sigma_idx, non_lin_idx, beta_idx, baseline_idx, rsq_idx = 0, 1, 2, 3, 4, 5, 6
-    
-    # pRF sign
-    prf_sign_all = np.sign((prf_data[beta_idx,:]))
-    pos_mask = prf_sign_all > 0.0
-    neg_mask = prf_sign_all < 0.0
-    all_mask = pos_mask | neg_mask
-    
-    # r-square
-    prf_rsq_all = prf_data[rsq_idx,:]
+    prf_deriv = compute_prf_derivatives(prf_data = prf_data,
+                                        fit_model = fit_model,
+                                        stim_radius = stim_radius,
+                                        memory_budget = memory_budget,
+                                        cov_method = cov_method)
 
-    # pRF eccentricity
-    prf_ecc_all = np.nan_to_num(np.sqrt(prf_data[x_idx,:]**2 + prf_data[y_idx,:]**2))
+    # Saving
+    # ------
+    if save_gii:
+        save_prf_derivatives(   prf_deriv = prf_deriv,
+                                output_dir = output_dir,
+                                hemi = hemi,
+                                header = prf_data_load.header,
+                                extra = prf_data_load.extra)
 
-    # pRF polar angle
-    complex_polar = prf_data[x_idx,:] + 1j * prf_data[y_idx,:]
-    normed_polar = complex_polar / np.abs(complex_polar)
-    prf_polar_real_all = np.real(normed_polar)
-    prf_polar_imag_all = np.imag(normed_polar)
-    
-    # pRF size
-    prf_size_all = prf_data[sigma_idx,:].astype(np.float64)
-    prf_size_all[prf_size_all<1e-4] = 1e-4
+    return prf_deriv
 
-    # pRF non-linearity
-    if fit_model == 'gauss':
-        prf_non_lin_all = np.zeros((prf_size_all.shape))*np.nan
-    elif fit_model == 'css':
-        prf_non_lin_all = prf_data[non_lin_idx,:]
+def merge_fit_chunks(chunk_files, output_file, vox_num, fit_val, n_threads = 8):
+    """
+    Merge fit slice files in one estimate file, reading slices concurrently and
+    copying only their own vertex columns. Slices already merged in an existing
+    output file (listed in its _merged.json side file) are not read again.
 
-    # pRF amplitude
-    if fit_model == 'gauss':
-        prf_amp_all = prf_data[beta_idx,:]
-    elif fit_model == 'css':
-        prf_amp_all = prf_data[beta_idx,:]
+    Parameters
+    ----------
+    chunk_files: absolute paths to fit slice files (*_est_<start>_to_<end>.gii)
+    output_file: absolute path of the merged estimate file
+    vox_num: number of vertices of the hemisphere
+    fit_val: number of fit estimates
+    n_threads: number of slice files read in parallel
 
-    # pRF baseline
-    if fit_model == 'gauss':
-        prf_baseline_all = prf_data[baseline_idx,:]
-    elif fit_model == 'css':
-        prf_baseline_all = prf_data[baseline_idx,:]
+    Returns
+    -------
+    data: merged estimates (fit_val x vox_num), nan for vertices not merged yet
+    header: gifti header of the merged file
+    gaps: list of (start, end) vertex ranges not covered by merged slices
+    """
 
-    # pRF coverage
-    deg_x, deg_y = np.meshgrid(np.linspace(-30, 30, 121), np.linspace(-30, 30, 121))         # define prfs in visual space
-    
-    rfs = generate_og_receptive_fields( prf_data[x_idx,:],
-                                        prf_data[y_idx,:],
-                                        prf_size_all,
-                                        np.ones(np.prod(prf_data[0,:].shape[0])),
-                                        deg_x,
-                                        deg_y)
-    if fit_model == 'css':
-        rfs = rfs ** prf_data[non_lin_idx,:]
-
-    total_prf_content = rfs.reshape((-1, prf_data.shape[1])).sum(axis=0)
-    stim_vignet = np.sqrt(deg_x ** 2 + deg_y**2) < stim_radius    
-    prf_cov_all = rfs[stim_vignet, :].sum(axis=0) / total_prf_content
+    # Imports
+    # -------
+    # General imports
+    import json
+    from concurrent.futures import ThreadPoolExecutor
 
-    # pRF x
-    prf_x_all = prf_data[x_idx,:]
+    # Slice ranges
+    # ------------
+    chunks = {}
+    for chunk_file in chunk_files:
+        start_idx, end_idx = [int(idx) for idx in chunk_file[:-4].split('_est_')[-1].split('_to_')]
+        chunks[chunk_file] = [start_idx, end_idx, os.path.getsize(chunk_file), os.path.getmtime(chunk_file)]
 
-    # pRF y
-    prf_y_all = prf_data[y_idx,:]
+    ranges = sorted(set([(chunk[0], chunk[1]) for chunk in chunks.values()]))
+    for (start_a, end_a), (start_b, end_b) in zip(ranges[:-1], ranges[1:]):
+        if start_b < end_a:
+            raise ValueError('fit slices %i to %i and %i to %i overlap'%(start_a, end_a, start_b, end_b))
 
-    # Saving
-    # ------
-    for mask_dir in ['all','pos','neg']:
-        print('saving: %s'%('os.path.join(output_dir,"{mask_dir}","prf_deriv_{hemi}_{mask_dir}.gii")'.format(hemi = hemi, mask_dir = mask_dir)))
-        for output_type in ['prf_sign','prf_rsq','prf_ecc','prf_polar_real','prf_polar_imag','prf_size','prf_non_lin','prf_amp','prf_baseline','prf_cov','prf_x','prf_y']:
-            exec('{output_type}_{mask_dir} = np.copy({output_type}_all)'.format(mask_dir = mask_dir, output_type = output_type))
-            exec('{output_type}_{mask_dir}[~{mask_dir}_mask] = np.nan'.format(mask_dir = mask_dir, output_type = output_type))
-        
-        exec('prf_deriv_{mask_dir} = np.row_stack((prf_sign_{mask_dir},prf_rsq_{mask_dir},prf_ecc_{mask_dir},prf_polar_real_{mask_dir},\
-                prf_polar_imag_{mask_dir},prf_size_{mask_dir},prf_non_lin_{mask_dir},prf_amp_{mask_dir},prf_baseline_{mask_dir},prf_cov_{mask_dir},\
-                prf_x_{mask_dir},prf_y_{mask_dir}))'.format(mask_dir = mask_dir))
-        
-        exec('prf_deriv_{mask_dir} = prf_deriv_{mask_dir}.astype(np.float32)'.format(mask_dir = mask_dir))
-        exec('darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in prf_deriv_{mask_dir}]'.format(mask_dir = mask_dir))
-        exec('gii_out = nb.gifti.gifti.GiftiImage(header = hdr, extra = ext, darrays = darrays)')
-        exec('nb.save(gii_out,os.path.join(output_dir,"{mask_dir}","prf_deriv_{hemi}_{mask_dir}.gii"))'.format(hemi = hemi, mask_dir = mask_dir))
+    # Previous merge
+    # --------------
+    merged_file = output_file[:-4] + '_merged.json'
+    merged, data, header, extra = {}, None, None, None
+    if os.path.isfile(output_file) and os.path.isfile(merged_file):
+        with open(merged_file) as f:
+            merged_info = json.load(f)
+        if merged_info['vox_num'] == vox_num and merged_info['fit_val'] == fit_val:
+            output_load = nb.load(output_file)
+            data = np.vstack([darray.data for darray in output_load.darrays]).astype(np.float32)
+            header, extra = output_load.header, output_load.extra
+            merged = {chunk_file: chunk for chunk_file, chunk in merged_info['chunks'].items()
+                        if chunks.get(chunk_file) == chunk}
+    if data is None:
+        data = np.full((fit_val, vox_num), np.nan, dtype = np.float32)
+
+    # Merge new slices
+    # ----------------
+    def merge_chunk(chunk_file):
+        start_idx, end_idx = chunks[chunk_file][:2]
+        chunk_load = nb.load(chunk_file)
+        for est_num, darray in enumerate(chunk_load.darrays):
+            if darray.data.shape[0] == vox_num:
+                # hemisphere-wide slice files of former fits
+                data[est_num, start_idx:end_idx] = darray.data[start_idx:end_idx]
+            else:
+                data[est_num, start_idx:end_idx] = darray.data
+        return chunk_load.header, chunk_load.extra
+
+    new_files = [chunk_file for chunk_file in chunks.keys() if chunk_file not in merged]
+    if len(new_files) > 0:
+        with ThreadPoolExecutor(max_workers = n_threads) as executor:
+            for chunk_header, chunk_extra in executor.map(merge_chunk, new_files):
+                if header is None: header, extra = chunk_header, chunk_extra
+
+        for chunk_file in new_files:
+            merged[chunk_file] = chunks[chunk_file]
+
+        # save merged file and its slice list
+        darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in data]
+        gii_out = nb.gifti.gifti.GiftiImage(header = header, extra = extra, darrays = darrays)
+        nb.save(gii_out, output_file[:-4] + '_tmp.gii')
+        os.replace(output_file[:-4] + '_tmp.gii', output_file)
+        with open(merged_file[:-5] + '_tmp.json', 'w') as f:
+            json.dump({'vox_num': vox_num, 'fit_val': fit_val, 'chunks': merged}, f)
+        os.replace(merged_file[:-5] + '_tmp.json', merged_file)
+
+    # Gaps
+    # ----
+    gaps, last_idx = [], 0
+    for start_idx, end_idx in sorted(set([(chunk[0], chunk[1]) for chunk in merged.values()])):
+        if start_idx > last_idx: gaps.append((last_idx, start_idx))
+        last_idx = max(last_idx, end_idx)
+    if last_idx < vox_num: gaps.append((last_idx, vox_num))
+
+    return data, header, gaps
+
+def surface_barycentric_weights(surf_coords, surf_faces, query_coords, block_size = 20000, num_near = (3, 8, 20, 50)):
+    """
+    Find for each query point the sphere triangle it falls in and its barycentric weights
+
+    Parameters
+    ----------
+    surf_coords: sphere vertex coordinates (vertices x 3)
+    surf_faces: sphere triangles (triangles x 3)
+    query_coords: query point coordinates on a sphere (points x 3)
+    block_size: number of query points treated at once
+    num_near: numbers of closest vertices whose triangles are searched, widened
+              until the triangle containing the point is found
+
+    Returns
+    -------
+    weights: sparse matrix (points x vertices) of barycentric weights
+    """
+
+    # Imports
+    # -------
+    # General imports
+    from scipy.spatial import cKDTree
+    from scipy.sparse import csr_matrix
+
+    surf_coords = surf_coords / np.linalg.norm(surf_coords, axis = 1)[:,np.newaxis]
+    query_coords = query_coords / np.linalg.norm(query_coords, axis = 1)[:,np.newaxis]
+    num_vert, num_query = surf_coords.shape[0], query_coords.shape[0]
+    num_near = [np.min((k, num_vert)) for k in num_near]
+
+    # triangles around each vertex (padded with -1)
+    vert_faces = [[] for vert in range(num_vert)]
+    for face_num, face in enumerate(surf_faces):
+        for vert in face: vert_faces[vert].append(face_num)
+    vert_faces_mat = -np.ones((num_vert, np.max([len(faces) for faces in vert_faces])), dtype = int)
+    for vert, faces in enumerate(vert_faces): vert_faces_mat[vert,:len(faces)] = faces
+
+    def face_bary(points, cand_faces):
+        """barycentric weights of points in candidate triangles, along the ray from sphere center"""
+        valid = cand_faces >= 0
+        tri = surf_faces[np.where(valid, cand_faces, 0)]
+        vert_a, vert_b, vert_c = surf_coords[tri[...,0]], surf_coords[tri[...,1]], surf_coords[tri[...,2]]
+        edge_1, edge_2 = vert_b - vert_a, vert_c - vert_a
+        ray = np.broadcast_to(points[:,np.newaxis,:], edge_1.shape)
+        ray_x_edge_2 = np.cross(ray, edge_2)
+        det = np.sum(edge_1 * ray_x_edge_2, axis = -1)
+        det[det == 0] = np.finfo(float).tiny
+        bary_b = np.sum(-vert_a * ray_x_edge_2, axis = -1) / det
+        bary_c = np.sum(ray * np.cross(-vert_a, edge_1), axis = -1) / det
+        bary = np.stack((1 - bary_b - bary_c, bary_b, bary_c), axis = -1)
+
+        # triangle on the side of the point (not its antipode), least negative weight first
+        front = np.sum(ray * (vert_a + vert_b + vert_c), axis = -1) > 0
+        score = np.where(valid & front, bary.min(axis = -1), -np.inf)
+        best = np.argmax(score, axis = 1)
+        pts = np.arange(points.shape[0])
+        return tri[pts, best], bary[pts, best], score[pts, best]
+
+    tree = cKDTree(surf_coords)
+    rows = np.repeat(np.arange(num_query), 3)
+    cols = np.zeros((num_query, 3), dtype = int)
+    vals = np.zeros((num_query, 3))
+    num_outside = 0
+    for block_start in np.arange(0, num_query, block_size):
+        block_end = np.min((block_start + block_size, num_query))
+        block_pts = np.arange(block_start, block_end)
+
+        # widen the candidate triangles of points not found in a triangle yet
+        for k in num_near:
+            near_verts = tree.query(query_coords[block_pts], k = k)[1].reshape(block_pts.shape[0], -1)
+            tri, bary, score = face_bary(query_coords[block_pts], vert_faces_mat[near_verts].reshape(block_pts.shape[0], -1))
+            cols[block_pts], vals[block_pts] = tri, bary
+            block_pts = block_pts[score < -1e-6]
+            if block_pts.shape[0] == 0: break
+        num_outside += block_pts.shape[0]
+
+    if num_outside > 0:
+        print('%i points outside of all searched triangles, projected on closest triangle'%num_outside)
+    vals = np.clip(vals, 0, None)
+    vals = vals / vals.sum(axis = 1)[:,np.newaxis]
+
+    weights = csr_matrix((vals.ravel(), (rows, cols.ravel())), shape = (num_query, num_vert))
+    weights.eliminate_zeros()
+
+    return weights
+
+def resample_weights(current_sphere, new_sphere, current_area, new_area, cache_dir = None):
+    """
+    Compute surface resampling weights of wb_command -metric-resample ADAP_BARY_AREA
+    with -area-metrics, cached as sparse matrix in cache_dir
+
+    Parameters
+    ----------
+    current_sphere: sphere gifti file in register with the current mesh
+    new_sphere: sphere gifti file in register with the new mesh
+    current_area: vertex area gifti file of the current mesh
+    new_area: vertex area gifti file of the new mesh
+    cache_dir: folder of cached weight files (None for no cache)
+
+    Returns
+    -------
+    weights: sparse matrix (new vertices x current vertices), rows summing to 1
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import hashlib
+    import zipfile
+    from scipy.sparse import diags, load_npz, save_npz
+
+    # Cached weights
+    # --------------
+    if cache_dir is not None:
+        file_hash = hashlib.sha1(b'adap_bary_area')
+        for file_name in [current_sphere, new_sphere, current_area, new_area]:
+            with open(file_name, 'rb') as f:
+                file_hash.update(f.read())
+        cache_file = os.path.join(cache_dir, 'resample_%s.npz'%file_hash.hexdigest())
+        if os.path.isfile(cache_file):
+            try: return load_npz(cache_file).tocsr()
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                print('unreadable resampling weights %s, computed again'%cache_file)
+
+    # Barycentric weights
+    # -------------------
+    current_load, new_load = nb.load(current_sphere), nb.load(new_sphere)
+    current_coords, current_faces = current_load.agg_data('NIFTI_INTENT_POINTSET'), current_load.agg_data('NIFTI_INTENT_TRIANGLE')
+    new_coords, new_faces = new_load.agg_data('NIFTI_INTENT_POINTSET'), new_load.agg_data('NIFTI_INTENT_TRIANGLE')
+    current_area = nb.load(current_area).darrays[0].data.astype(np.float64)
+    new_area = nb.load(new_area).darrays[0].data.astype(np.float64)
+
+    # new vertices on current mesh (forward) and current vertices gathered on new mesh (reverse)
+    forward = surface_barycentric_weights(current_coords, current_faces, new_coords)
+    reverse = surface_barycentric_weights(new_coords, new_faces, current_coords).T.tocsr()
+
+    # adaptive: use the mapping reaching the most current vertices
+    use_reverse = (reverse.getnnz(axis = 1) > forward.getnnz(axis = 1)).astype(float)
+    weights = (diags(1 - use_reverse) @ forward + diags(use_reverse) @ reverse).tocsr()
+
+    # area correction: scatter each current vertex in proportion to the new vertex areas,
+    # scale by current vertex area, then normalize the gathering weights
+    weights = diags(new_area) @ weights
+    scatter_sum = np.asarray(weights.sum(axis = 0)).ravel()
+    scatter_scale = np.zeros(scatter_sum.shape)
+    scatter_scale[scatter_sum != 0] = current_area[scatter_sum != 0] / scatter_sum[scatter_sum != 0]
+    weights = weights @ diags(scatter_scale)
+    weights_sum = np.asarray(weights.sum(axis = 1)).ravel()
+    weights_sum[weights_sum == 0] = 1
+    weights = (diags(1 / weights_sum) @ weights).tocsr()
+    weights.eliminate_zeros()
+
+    if cache_dir is not None:
+        try: os.makedirs(cache_dir)
+        except OSError: pass
+        with open(tmp_file(cache_file), 'wb') as f:
+            save_npz(f, weights)
+        os.replace(tmp_file(cache_file), cache_file)
+
+    return weights
+
+def resample_metric(data, weights, nan_mask = False, min_valid = 0.5):
+    """
+    Resample metric rows with surface resampling weights. As with wb_command
+    -metric-resample, a nan vertex makes nan every new vertex it contributes to,
+    unless nan_mask is set: nan vertices are then masked out before the weights
+    are normalized
+
+    Parameters
+    ----------
+    data: metric data (rows x current vertices), several metrics can be stacked
+    weights: resampling weights (output of resample_weights)
+    nan_mask: mask out nan vertices instead of propagating them
+    min_valid: minimal weight of non-nan vertices for a new vertex not to be nan (nan_mask only)
+
+    Returns
+    -------
+    data_resampled: metric data (rows x new vertices)
+    """
+
+    data = np.asarray(data, dtype = np.float64)
+    valid = np.isfinite(data)
+    if not nan_mask or np.all(valid):
+        return (weights @ data.T).T.astype(np.float32)
+
+    data_sum = (weights @ np.where(valid, data, 0).T).T
+    valid_sum = (weights @ valid.T.astype(np.float64)).T
+    data_resampled = np.full(data_sum.shape, np.nan)
+    keep = valid_sum >= min_valid
+    data_resampled[keep] = data_sum[keep] / valid_sum[keep]
+
+    return data_resampled.astype(np.float32)
+
+def wb_metric_resample(wb_cmd, data, current_sphere, new_sphere, current_area, new_area):
+    """
+    Resample metric rows with wb_command -metric-resample ADAP_BARY_AREA -area-metrics
+
+    Parameters
+    ----------
+    wb_cmd: path to wb_command
+    data: metric data (rows x current vertices)
+    current_sphere: sphere gifti file in register with the current mesh
+    new_sphere: sphere gifti file in register with the new mesh
+    current_area: vertex area gifti file of the current mesh
+    new_area: vertex area gifti file of the new mesh
+
+    Returns
+    -------
+    data_resampled: metric data (rows x new vertices)
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        metric_in, metric_out = os.path.join(tmp_dir, 'metric_in.func.gii'), os.path.join(tmp_dir, 'metric_out.func.gii')
+        nb.save(nb.gifti.gifti.GiftiImage(darrays = [nb.gifti.gifti.GiftiDataArray(d) for d in np.asarray(data, dtype = np.float32)]), metric_in)
+        subprocess.run([wb_cmd, '-metric-resample', metric_in, current_sphere, new_sphere, 'ADAP_BARY_AREA', metric_out,
+                        '-area-metrics', current_area, new_area], check = True)
+        data_resampled = np.vstack([darray.data for darray in nb.load(metric_out).darrays]).astype(np.float32)
+
+    return data_resampled
+
+def resample_surface_data(data, resample_files, method = 'wb_command', wb_cmd = 'wb_command', cache_dir = None, nan_mask = False):
+    """
+    Resample metric rows to a new mesh with wb_command or with cached python weights
+
+    Parameters
+    ----------
+    data: metric data (rows x current vertices)
+    resample_files: (current_sphere, new_sphere, current_area, new_area) files
+    method: 'wb_command' or 'python' (see resample_weights)
+    wb_cmd: path to wb_command
+    cache_dir: folder of cached python weight files
+    nan_mask: mask out nan vertices instead of propagating them (python only, see resample_metric)
+
+    Returns
+    -------
+    data_resampled: metric data (rows x new vertices)
+    """
+
+    if method == 'wb_command':
+        return wb_metric_resample(wb_cmd, data, *resample_files)
+
+    weights = resample_weights(*resample_files, cache_dir = cache_dir)
+
+    return resample_metric(data = data, weights = weights, nan_mask = nan_mask)
+
+def validate_resampling(metric_in, metric_wb, weights):
+    """
+    Compare python resampling to wb_command -metric-resample output of the same metric file
+
+    Parameters
+    ----------
+    metric_in: metric gifti file to resample
+    metric_wb: resampled metric gifti file obtained with wb_command
+    weights: resampling weights (output of resample_weights)
+
+    Returns
+    -------
+    max_abs_diff: maximal absolute difference per metric row
+    corr: correlation with wb_command output per metric row
+    nan_diff: number of vertices nan in only one of the outputs per metric row
+    """
+
+    data_py = resample_metric(np.vstack([darray.data for darray in nb.load(metric_in).darrays]), weights)
+    data_wb = np.vstack([darray.data for darray in nb.load(metric_wb).darrays])
+
+    max_abs_diff, corr, nan_diff = [], [], []
+    for row_py, row_wb in zip(data_py, data_wb):
+        finite = np.isfinite(row_py) & np.isfinite(row_wb)
+        nan_diff.append(np.sum(np.isfinite(row_py) != np.isfinite(row_wb)))
+        max_abs_diff.append(np.max(np.abs(row_py[finite] - row_wb[finite])) if np.any(finite) else np.nan)
+        corr.append(np.corrcoef(row_py[finite], row_wb[finite])[0,1] if np.sum(finite) > 1 else np.nan)
+
+    return np.array(max_abs_diff), np.array(corr), np.array(nan_diff)
+
+def roi_mask_indices(rois, resample_files, cache_dir, subject = 'fsaverage', resample_method = 'wb_command', wb_cmd = 'wb_command'):
+    """
+    Get ROI vertex indices from the pycortex overlays.svg of subject and resampled
+    to a target mesh, cached in cache_dir under a key made of the overlays.svg
+    content, the ROI list and the target mesh files
+
+    Parameters
+    ----------
+    rois: list of roi names drawn in overlays.svg
+    resample_files: dictionary by hemisphere of (current_sphere, new_sphere, current_area, new_area)
+                    files to resample from the subject mesh to the target mesh
+    cache_dir: folder of cached roi index files
+    subject: pycortex subject of the overlays.svg
+    resample_method: 'wb_command' or 'python' (see resample_surface_data)
+    wb_cmd: path to wb_command
+
+    Returns
+    -------
+    roi_idx: dictionary of vertex index arrays by mesh ('fsaverage' or 'target'), hemisphere and roi
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import hashlib
+    import json
+    import cortex
+
+    # Cached indices
+    # --------------
+    overlay_file = cortex.db.get_paths(subject)['overlays']
+    key_hash = hashlib.sha1()
+    with open(overlay_file, 'rb') as f:
+        key_hash.update(f.read())
+    key_hash.update(json.dumps([rois, resample_method]).encode())
+    for hemi in sorted(resample_files.keys()):
+        for file_name in resample_files[hemi]:
+            with open(file_name, 'rb') as f:
+                key_hash.update(f.read())
+    cache_file = os.path.join(cache_dir, 'roi_masks_%s.npz'%key_hash.hexdigest())
+
+    roi_idx = {'fsaverage': {}, 'target': {}}
+    if os.path.isfile(cache_file):
+        cache = np.load(cache_file)
+        for key in cache.files:
+            mesh, hemi, roi = key.split('__', 2)
+            roi_idx[mesh].setdefault(hemi, {})[roi] = cache[key]
+        return roi_idx
+
+    # Compute indices
+    # ---------------
+    print('creating roi masks from overlays.svg')
+    masks = cortex.utils.get_roi_verts(subject = subject, roi = rois, mask = True)
+    num_vert_hemi = masks[rois[0]].shape[0] // 2
+    for hemi_num, hemi in enumerate(['L','R']):
+        mat_masks = np.vstack([masks[roi][hemi_num*num_vert_hemi:(hemi_num+1)*num_vert_hemi] for roi in rois]).astype(np.float32)
+        mat_masks_target = resample_surface_data(   data = mat_masks,
+                                                    resample_files = resample_files[hemi],
+                                                    method = resample_method,
+                                                    wb_cmd = wb_cmd,
+                                                    cache_dir = os.path.join(os.path.split(cache_dir)[0], 'resample_cache'))
+
+        roi_idx['fsaverage'][hemi], roi_idx['target'][hemi] = {}, {}
+        for roi_num, roi in enumerate(rois):
+            roi_idx['fsaverage'][hemi][roi] = np.where(mat_masks[roi_num] == 1)[0].astype(np.int32)
+            roi_idx['target'][hemi][roi] = np.where(np.round(mat_masks_target[roi_num]) == 1)[0].astype(np.int32)
+
+    try: os.makedirs(cache_dir)
+    except OSError: pass
+    with open(tmp_file(cache_file), 'wb') as f:
+        np.savez(f, **{'%s__%s__%s'%(mesh, hemi, roi): roi_idx[mesh][hemi][roi]
+                        for mesh in roi_idx.keys() for hemi in roi_idx[mesh].keys() for roi in rois})
+    os.replace(tmp_file(cache_file), cache_file)
+
+    return roi_idx
+
+def roi_derivs_2_hdf5(deriv_data, roi_idx, h5_dir):
+    """
+    Extract all ROIs of derivative data in one pass and save them in one hdf5 file
+    per ROI, with the '{hemi}_{mask_dir}/prf_deriv_{hemi}_{mask_dir}' layout of mask_gii_2_hdf5
+
+    Parameters
+    ----------
+    deriv_data: dictionary by (hemi, mask_dir) of derivative data (12 x vertices)
+    roi_idx: dictionary by hemisphere and roi of vertex indices (see roi_mask_indices)
+    h5_dir: absolute path to folder of roi hdf5 files
+
+    Returns
+    -------
+    None
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import h5py
+
+    try: os.makedirs(h5_dir)
+    except OSError: pass
+
+    rois = list(roi_idx[list(roi_idx.keys())[0]].keys())
+    for roi in rois:
+        h5_file = os.path.join(h5_dir,'{roi}.h5'.format(roi = roi))
+        with h5py.File(h5_file[:-3] + '_tmp.h5', 'w') as h5file:
+            for (hemi, mask_dir), data_mat in deriv_data.items():
+                folder_alias = '{hemi}_{mask_dir}'.format(hemi = hemi, mask_dir = mask_dir)
+                data_name = 'prf_deriv_{hemi}_{mask_dir}'.format(hemi = hemi, mask_dir = mask_dir)
+                h5file.create_dataset(  '{folder_alias}/{data_name}'.format(folder_alias = folder_alias, data_name = data_name),
+                                        data = data_mat[:, roi_idx[hemi][roi]],
+                                        dtype = 'float32')
+        os.replace(h5_file[:-3] + '_tmp.h5', h5_file)
 
     return None
 
+@contextlib.contextmanager
+def file_lock(lock_file, timeout = 3600):
+    """
+    Exclusive lock between processes and hosts sharing a folder, held with a
+    POSIX lock on lock_file and released on exit or when the process dies
+
+    Parameters
+    ----------
+    lock_file: absolute path to lock file
+    timeout: maximal waiting time in seconds before giving up
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import time
+    import fcntl
+    import random
+
+    start_time = time.time()
+    with open(lock_file, 'a') as lock:
+        while True:
+            try:
+                fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.time() - start_time > timeout:
+                    raise TimeoutError('lock %s held for more than %i s'%(lock_file, timeout))
+                time.sleep(random.uniform(1, 2))
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+def append_cohort_store(cohort_file, subject, deriv_data, roi_idx, chunk_rows = 8192):
+    """
+    Append one subject's ROI derivatives to a cohort hdf5 store holding all subjects,
+    replacing the segments of a subject already in the store (its old rows are left
+    unreferenced), in chunked compressed datasets:
+    deriv/{mask_dir}: derivatives (rows x 12)
+    vertex: vertex index of each row
+    segments: subject, roi, hemi, first row and last row + 1 of each block of rows
+    subjects, rois, hemis: name tables indexed by segments columns
+
+    Parameters
+    ----------
+    cohort_file: absolute path to cohort hdf5 file
+    subject: subject name
+    deriv_data: dictionary by (hemi, mask_dir) of derivative data (12 x vertices)
+    roi_idx: dictionary by hemisphere and roi of vertex indices (see roi_mask_indices)
+    chunk_rows: number of rows per hdf5 chunk
+
+    Returns
+    -------
+    replaced: True if the subject was already in the store and its rows were replaced
+
+    Note
+    ----
+    appends of several subject jobs are serialized with a lock file next to cohort_file
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import h5py
+
+    hemis = sorted(set([hemi for hemi, mask_dir in deriv_data.keys()]))
+    mask_dirs = sorted(set([mask_dir for hemi, mask_dir in deriv_data.keys()]))
+    rois = list(roi_idx[hemis[0]].keys())
+    str_dtype = h5py.string_dtype()
+
+    with file_lock(cohort_file + '.lock'):
+        with h5py.File(cohort_file, 'a') as h5file:
+
+            # Create store
+            # ------------
+            if 'segments' not in h5file:
+                for mask_dir in mask_dirs:
+                    h5file.create_dataset(  'deriv/{mask_dir}'.format(mask_dir = mask_dir), shape = (0, 12), maxshape = (None, 12),
+                                            dtype = 'float32', chunks = (chunk_rows, 12), compression = 'gzip', shuffle = True)
+                h5file.create_dataset('vertex', shape = (0,), maxshape = (None,), dtype = 'int32', chunks = (chunk_rows,), compression = 'gzip')
+                h5file.create_dataset('segments', shape = (0, 5), maxshape = (None, 5), dtype = 'int64', chunks = (1024, 5))
+                for table in ['subjects','rois','hemis']:
+                    h5file.create_dataset(table, shape = (0,), maxshape = (None,), dtype = str_dtype, chunks = (1024,))
+
+            # Name tables
+            # -----------
+            def table_index(table, name):
+                names = list(h5file[table].asstr()[:])
+                if name not in names:
+                    h5file[table].resize((len(names) + 1,))
+                    h5file[table][len(names)] = name
+                    names.append(name)
+                return names.index(name)
+
+            subject_num = table_index('subjects', subject)
+            old_segments = h5file['segments'][:]
+            replaced = bool(np.any(old_segments[:,0] == subject_num))
+
+            # Append rows
+            # -----------
+            num_rows = h5file['vertex'].shape[0]
+            segments, vertex, rows = [], [], {mask_dir: [] for mask_dir in mask_dirs}
+            for hemi in hemis:
+                hemi_num = table_index('hemis', hemi)
+                for roi in rois:
+                    roi_num = table_index('rois', roi)
+                    idx = roi_idx[hemi][roi]
+                    segments.append([subject_num, roi_num, hemi_num, num_rows, num_rows + idx.shape[0]])
+                    num_rows += idx.shape[0]
+                    vertex.append(idx)
+                    for mask_dir in mask_dirs:
+                        rows[mask_dir].append(deriv_data[(hemi, mask_dir)][:, idx].T)
+
+            start_row = h5file['vertex'].shape[0]
+            h5file['vertex'].resize((num_rows,))
+            h5file['vertex'][start_row:] = np.concatenate(vertex)
+            for mask_dir in mask_dirs:
+                h5file['deriv'][mask_dir].resize((num_rows, 12))
+                h5file['deriv'][mask_dir][start_row:] = np.vstack(rows[mask_dir])
+
+            # segments written last, so that an interrupted append is ignored by readers
+            if replaced:
+                segments = np.vstack((old_segments[old_segments[:,0] != subject_num], np.array(segments)))
+                h5file['segments'].resize((segments.shape[0], 5))
+                h5file['segments'][:] = segments
+            else:
+                num_seg = h5file['segments'].shape[0]
+                h5file['segments'].resize((num_seg + len(segments), 5))
+                h5file['segments'][num_seg:] = np.array(segments)
+
+    return replaced
+
+def read_cohort_store(cohort_file, subjects = None, rois = None, hemis = None, mask_dir = 'all'):
+    """
+    Read ROI derivatives of a subject/roi/hemisphere selection from a cohort hdf5 store
+
+    Parameters
+    ----------
+    cohort_file: absolute path to cohort hdf5 file
+    subjects: list of subject names (None for all)
+    rois: list of roi names (None for all)
+    hemis: list of hemispheres (None for all)
+    mask_dir: derivative mask ('all','pos','neg')
+
+    Returns
+    -------
+    data: concatenated derivatives (rows x 12)
+    table: dictionary of 'subject', 'roi', 'hemi' names and 'vertex' index of each row
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import h5py
+
+    with h5py.File(cohort_file, 'r') as h5file:
+        segments = h5file['segments'][:]
+        names = {table: np.array(h5file[table].asstr()[:], dtype = object) for table in ['subjects','rois','hemis']}
+
+        # Select segments
+        # ---------------
+        keep = np.ones(segments.shape[0], dtype = bool)
+        for col, table, selection in zip([0,1,2], ['subjects','rois','hemis'], [subjects, rois, hemis]):
+            if selection is not None:
+                keep &= np.isin(names[table][segments[:,col]], selection)
+        segments = segments[keep]
+
+        # Read contiguous row spans
+        # -------------------------
+        order = np.argsort(segments[:,3])
+        spans = []
+        for start_row, end_row in segments[order,3:5]:
+            if len(spans) > 0 and spans[-1][1] == start_row: spans[-1][1] = end_row
+            else: spans.append([start_row, end_row])
+
+        deriv = h5file['deriv'][mask_dir]
+        vertex = h5file['vertex']
+        if len(spans) > 0:
+            data = np.vstack([deriv[start_row:end_row] for start_row, end_row in spans])
+            vertex = np.concatenate([vertex[start_row:end_row] for start_row, end_row in spans])
+        else:
+            data, vertex = np.zeros((0, 12), dtype = np.float32), np.zeros(0, dtype = np.int32)
+
+    seg_len = segments[order,4] - segments[order,3]
+    table = {   'subject': np.repeat(names['subjects'][segments[order,0]], seg_len),
+                'roi': np.repeat(names['rois'][segments[order,1]], seg_len),
+                'hemi': np.repeat(names['hemis'][segments[order,2]], seg_len),
+                'vertex': vertex}
+
+    return data, table
+
+def flatmap_mapper(subject = 'fsaverage', height = 1024, cache_dir = None):
+    """
+    Get the pycortex flatmap vertex to pixel sampling matrix and flatmap mask of
+    subject, cached in cache_dir under a key made of the flat surfaces and height
+
+    Parameters
+    ----------
+    subject: pycortex subject
+    height: flatmap image height in pixels
+    cache_dir: folder of cached mapper files (None for no cache)
+
+    Returns
+    -------
+    pixmap: sparse matrix (flatmap pixels x vertices)
+    mask: flatmap pixels mask (width x height)
+    extents: flatmap image extents
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import hashlib
+    import cortex
+    from scipy.sparse import load_npz, save_npz
+
+    # Cached mapper
+    # -------------
+    if cache_dir is not None:
+        key_hash = hashlib.sha1(('%s_%i'%(subject, height)).encode())
+        flat_files = cortex.db.get_paths(subject)['surfs']['flat']
+        for hemi in sorted(flat_files.keys()):
+            with open(flat_files[hemi], 'rb') as f:
+                key_hash.update(f.read())
+        cache_file = os.path.join(cache_dir, 'flatmap_%s.npz'%key_hash.hexdigest())
+        if os.path.isfile(cache_file) and os.path.isfile(cache_file[:-4] + '_mask.npz'):
+            with np.load(cache_file[:-4] + '_mask.npz') as mask_cache:
+                mask, extents = mask_cache['mask'], list(mask_cache['extents'])
+            return load_npz(cache_file).tocsr(), mask, extents
+
+    # Compute mapper
+    # --------------
+    mask, extents = cortex.quickflat.utils.get_flatmask(subject, height = height)
+    pixmap = cortex.quickflat.utils._make_vertex_cache(subject, height = height).tocsr()
+
+    if cache_dir is not None:
+        try: os.makedirs(cache_dir)
+        except OSError: pass
+        with open(tmp_file(cache_file[:-4] + '_mask.npz'), 'wb') as f:
+            np.savez(f, mask = mask, extents = np.array(extents))
+        os.replace(tmp_file(cache_file[:-4] + '_mask.npz'), cache_file[:-4] + '_mask.npz')
+        with open(tmp_file(cache_file), 'wb') as f:
+            save_npz(f, pixmap)
+        os.replace(tmp_file(cache_file), cache_file)
+
+    return pixmap, mask, extents
+
+def render_flatmaps(data, pixmap, mask):
+    """
+    Render vertex data as flatmap images with one sparse product, without browser or display
+
+    Parameters
+    ----------
+    data: vertex data (vertices) or (maps x vertices), e.g. many maps or subjects,
+          or VertexRGB object (rendered as red, green, blue and alpha maps)
+    pixmap: sparse vertex to pixel matrix (see flatmap_mapper)
+    mask: flatmap pixels mask (see flatmap_mapper)
+
+    Returns
+    -------
+    images: flatmap images (height x width) or (maps x height x width), nan out of the flatmap,
+            (height x width x 4) for VertexRGB
+    """
+
+    is_rgb = hasattr(data, 'red')
+    if is_rgb:
+        alpha = data.alpha.data if data.alpha is not None else 255 * np.ones(data.red.data.shape)
+        data = np.vstack((data.red.data, data.green.data, data.blue.data, alpha)) / 255.0
+
+    data = np.atleast_2d(data)
+    pix_data = pixmap @ data.T
+
+    images = np.full((data.shape[0],) + mask.shape, np.nan)
+    images[:, mask] = pix_data.T
+    images = images.transpose((0, 2, 1))[:, ::-1, :]
+
+    if is_rgb: return images.transpose((1, 2, 0))
+    elif images.shape[0] == 1: return images[0]
+    else: return images
+
+def draw_cortex_vertex(subject, data, cmap, vmin, vmax, alpha = None, cbar = 'discrete', cmap_steps = 255,
+                       add_roi = False, roi_name = 'empty', image_file = None, height = 1024, cache_dir = None):
+    """
+    Make a VertexRGB of data colored with a pycortex colormap, render it as flatmap
+    image and optionally add it as layer to the subject overlays.svg
+
+    Parameters
+    ----------
+    subject: pycortex subject
+    data: vertex data
+    cmap: pycortex colormap name
+    vmin: colormap minimum
+    vmax: colormap maximum
+    alpha: vertex transparency (0 to 1, None for opaque)
+    cbar: colormap type ('discrete' for cmap_steps colors, 'continuous')
+    cmap_steps: number of colors of discrete colormap
+    add_roi: add the map as layer roi_name of overlays.svg
+    roi_name: name of overlays.svg layer
+    image_file: flatmap png image file (None for no image)
+    height: flatmap image height in pixels
+    cache_dir: folder of cached flatmap mappers
+
+    Returns
+    -------
+    vertex_rgb: pycortex VertexRGB object
+    """
+
+    # Imports
+    # -------
+    # General imports
+    import cortex
+    import matplotlib.colors as colors
+    import matplotlib.image as mpimg
+
+    # Color vertex
+    # ------------
+    base = cortex.utils.get_cmap(cmap)
+    if cbar == 'discrete':
+        colmap = colors.LinearSegmentedColormap.from_list('my_colmap', base(np.linspace(0, 1, cmap_steps + 1)), N = cmap_steps)
+        norm_data = np.clip((data - float(vmin)) / (float(vmax) - float(vmin)), 0, 1) * (cmap_steps - 1)
+        mat = colmap(np.nan_to_num(norm_data).astype(int))
+    else:
+        mat = base(np.clip((data - float(vmin)) / (float(vmax) - float(vmin)), 0, 1))
+
+    if alpha is None: alpha = np.ones(data.shape)
+    vertex_rgb = cortex.VertexRGB(  red = (mat[...,0]*255).astype(np.uint8),
+                                    green = (mat[...,1]*255).astype(np.uint8),
+                                    blue = (mat[...,2]*255).astype(np.uint8),
+                                    alpha = (alpha*255).astype(np.uint8),
+                                    subject = subject)
+
+    # Flatmap image
+    # -------------
+    if image_file is not None:
+        pixmap, mask, extents = flatmap_mapper(subject = subject, height = height, cache_dir = cache_dir)
+        image = render_flatmaps(vertex_rgb, pixmap, mask)
+        mpimg.imsave(image_file, np.nan_to_num(image).clip(0, 1))
+
+    # Add to overlays.svg
+    # -------------------
+    if add_roi:
+        cortex.utils.add_roi(vertex_rgb, name = roi_name, open_inkscape = False)
+
+    return vertex_rgb
+
 def mask_gii_2_hdf5(in_file, mask_file, hdf5_file, folder_alias, roi_num):
     """masks data in in_file with mask in mask_file,
     to be stored in an hdf5 file
@@ -257,9 +1178,6 @@ def mask_gii_2_hdf5(in_file, mask_file, hdf5_file, folder_alias, roi_num):
     import os.path as op
     import numpy as np
     import h5py
-    import ipdb
-    deb = ipdb.set_trace
-
 
     gii_in_data = nb.load(in_file)
     data_mat = np.array([gii_in_data.darrays[i].data for i in range(len(gii_in_data.darrays))])